@@ -0,0 +1,216 @@
+"""
+Benchmarks of optimized routines against their former implementations.
+Run as module, e.g. python -m pylib.benchmarks [name ...]
+"""
+
+import os
+import sys
+import time
+import tempfile
+import numpy as np
+from nptdms import TdmsWriter, ChannelObject
+
+from . import series
+from . import geometry
+from . import tdms
+from . import plot_utils
+
+
+def _timeit(function, *args, repeat=3, **kwargs):
+    """Return best wall time of repeated calls in seconds"""
+    best = np.inf
+    for __ in range(repeat):
+        start = time.perf_counter()
+        function(*args, **kwargs)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def _dtw_loop(series1, series2, dist_fn, win=None):
+    """Former pure Python implementation of series.dtw"""
+    if win is not None:
+        dist = np.full((len(series1) + 1, len(series2) + 1), np.inf)
+        for idx in range(1, len(series1) + 1):
+            dist[idx, max(1, idx - win[0]):min(len(series1) + 1, idx + win[1] + 1)] = 0
+        dist[0, 0] = 0
+    else:
+        dist = np.zeros((len(series1) + 1, len(series2) + 1))
+        dist[0, 1:] = np.inf
+        dist[1:, 0] = np.inf
+
+    acc_dist = dist[1:, 1:]
+
+    for idx, __ in enumerate(series1):
+        for jdx, __ in enumerate(series2):
+            if win is None or (max(0, idx - win[0]) <= jdx <= min(len(series2), idx + win[1])):
+                acc_dist[idx, jdx] = dist_fn(series1[idx] - series2[jdx])
+
+    jrange = range(len(series2))
+    for idx, __ in enumerate(series1):
+        if win is not None:
+            jrange = range(max(0, idx - win[0]), min(len(series2), idx + win[1] + 1))
+        for jdx in jrange:
+            acc_dist[idx, jdx] += min(
+                [
+                    dist[min(idx + 1, len(series1)), jdx],
+                    dist[idx, min(jdx + 1, len(series2))],
+                    dist[idx, jdx]
+                ]
+            )
+
+    idx, jdx = np.array(np.shape(dist)) - 2
+    path_x, path_y = [idx], [jdx]
+    while (idx > 0) or (jdx > 0):
+        t_b = np.argmin((dist[idx, jdx], dist[idx, jdx + 1], dist[idx + 1, jdx]))
+        if t_b == 0:
+            idx -= 1
+            jdx -= 1
+        elif t_b == 1:
+            idx -= 1
+        else:
+            jdx -= 1
+        path_x.insert(0, idx)
+        path_y.insert(0, jdx)
+
+    return acc_dist, [path_x, path_y]
+
+def bench_dtw(sizes=(100, 300, 1000), win_frac=0.1):
+    """Compare series.dtw and series.dtw_distance against the former implementation"""
+    rng = np.random.default_rng(0)
+    print(f"{'n':>6} {'loop':>10} {'dtw':>10} {'dtw(win)':>10} {'distance':>10}")
+    for size in sizes:
+        series1 = np.cumsum(rng.normal(size=size))
+        series2 = np.cumsum(rng.normal(size=size))
+        win = (int(size * win_frac), int(size * win_frac))
+        t_loop = _timeit(_dtw_loop, series1, series2, np.abs, repeat=1)
+        t_full = _timeit(series.dtw, series1, series2, np.abs)
+        t_band = _timeit(series.dtw, series1, series2, np.abs, win, banded=True)
+        t_dist = _timeit(series.dtw_distance, series1, series2, np.abs)
+        print(f"{size:>6} {t_loop:>10.4f} {t_full:>10.4f} {t_band:>10.4f} {t_dist:>10.4f}")
+
+def _write_tdms_per_channel(data, keys, groupname, pathname):
+    """Former implementation of tdms.write_tdms with one segment per channel"""
+    with TdmsWriter(pathname) as tdms_writer:
+        for idx, __ in enumerate(data):
+            channel = ChannelObject(groupname, keys[idx], np.array(data[idx]))
+            tdms_writer.write_segment([channel])
+
+def bench_write_tdms(nb_channels=(8, 64), nb_samples=(10**4, 10**6)):
+    """Compare write time, file size and read-back time of tdms.write_tdms"""
+    print(f"{'channels':>8} {'samples':>9} {'mode':>8} {'write':>8} {'read':>8} {'MB':>8}")
+    with tempfile.TemporaryDirectory() as directory:
+        for channels in nb_channels:
+            for samples in nb_samples:
+                data = np.random.default_rng(0).normal(size=(channels, samples))
+                keys = [f'ch{idx}' for idx in range(channels)]
+                for mode, writer in (('former', _write_tdms_per_channel), ('bulk', tdms.write_tdms)):
+                    pathname = os.path.join(directory, f'{mode}.tdms')
+                    t_write = _timeit(writer, data, keys, 'group', pathname)
+                    t_read = _timeit(tdms.read_tdms, pathname, keys, 'group')
+                    size = os.path.getsize(pathname) / 2**20
+                    print(
+                        f"{channels:>8} {samples:>9} {mode:>8} "
+                        f"{t_write:>8.4f} {t_read:>8.4f} {size:>8.2f}"
+                    )
+
+def bench_rotations(sizes=(10**3, 10**4, 10**5), nb_points=100):
+    """Compare geometry.rotation_matrices and rotate_points against looping over rotation_matrix"""
+    rng = np.random.default_rng(0)
+    print(f"{'n':>8} {'loop':>10} {'batched':>10} {'apply loop':>11} {'apply':>10}")
+    for size in sizes:
+        axes = rng.normal(size=(size, 3))
+        thetas = rng.uniform(-np.pi, np.pi, size)
+        cloud = rng.normal(size=(nb_points, 3))
+
+        def loop():
+            return [geometry.rotation_matrix(axis, theta) for axis, theta in zip(axes, thetas)]
+
+        matrices = geometry.rotation_matrices(axes, thetas)
+        t_loop = _timeit(loop, repeat=1)
+        t_batch = _timeit(geometry.rotation_matrices, axes, thetas)
+        t_apply_loop = _timeit(lambda: [cloud @ matrix.T for matrix in matrices], repeat=1)
+        t_apply = _timeit(geometry.rotate_points, cloud, matrices, per_sample=False)
+        print(f"{size:>8} {t_loop:>10.4f} {t_batch:>10.4f} {t_apply_loop:>11.4f} {t_apply:>10.4f}")
+
+def bench_histograms(widths=(16, 256, 4096), nb_histograms=1000):
+    """Compare geometry.largest_area_in_histograms against looping over largest_area_in_histogram"""
+    rng = np.random.default_rng(0)
+    print(f"{'width':>6} {'loop':>10} {'batched':>10}")
+    for width in widths:
+        histograms = rng.integers(0, 100, (nb_histograms, width)).astype(float)
+
+        def loop():
+            return [geometry.largest_area_in_histogram(histogram) for histogram in histograms]
+
+        t_loop = _timeit(loop, repeat=1)
+        t_batch = _timeit(geometry.largest_area_in_histograms, histograms)
+        print(f"{width:>6} {t_loop:>10.4f} {t_batch:>10.4f}")
+
+def bench_interactive_plotter(sizes=(10**3, 10**4, 10**5), rows=3, nb_updates=50):
+    """Compare time per update of the headless InteractivePlotter with full redraws and blitting"""
+    rng = np.random.default_rng(0)
+    modes = {
+        'full': {},
+        'blit': {'blit': True},
+        'blit/10': {'blit': True, 'every': 10},
+    }
+    print(f"{'n':>8} " + ' '.join(f'{mode:>10}' for mode in modes))
+    for size in sizes:
+        target = [np.sin(np.linspace(0, 20, size) + idx) for idx in range(rows)]
+        preds = [
+            [trace + 0.01 * rng.normal(size=size) for trace in target] for __ in range(nb_updates)
+        ]
+        timings = []
+        for kwargs in modes.values():
+            plotter = plot_utils.InteractivePlotter(
+                rows, (8, 6), 10, ['k', 'r'], headless=True, **kwargs
+            )
+            plotter.init_plot(target, target)
+
+            def run():
+                for pred in preds:
+                    plotter.update_plot(pred, target)
+                plotter.flush()
+
+            timings.append(_timeit(run, repeat=1) / nb_updates)
+        print(f"{size:>8} " + ' '.join(f'{timing:>10.5f}' for timing in timings))
+
+def _hist_patches(data, filename):
+    """Former rendering of plot_utils.hist with one colored patch per bin"""
+    fig = plot_utils.Figure(figsize=(7, 4))
+    plot_utils.FigureCanvasAgg(fig)
+    axs = fig.subplots(1, 1)
+    bins, __, patches = axs.hist(data, bins='fd')
+    fracs = bins / bins.max()
+    norm = plot_utils.colors.Normalize(fracs.min(), fracs.max())
+    for thisfrac, thispatch in zip(fracs, patches):
+        cmap = plot_utils.matplotlib.colormaps["viridis"]
+        thispatch.set_facecolor(cmap(norm(thisfrac)))
+    fig.savefig(filename, dpi=100, bbox_inches='tight')
+
+def bench_hist(sizes=(10**5, 10**6, 10**7)):
+    """Compare export of plot_utils.hist_batch against the former per-patch rendering"""
+    rng = np.random.default_rng(0)
+    print(f"{'n':>10} {'bins':>6} {'former':>10} {'counts':>10} {'export':>10}")
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, 'hist.png')
+        for size in sizes:
+            data = rng.normal(size=size)
+            nb_bins = len(plot_utils.histogram_counts(data)[0])
+            t_former = _timeit(_hist_patches, data, filename, repeat=1)
+            t_counts = _timeit(plot_utils.histogram_counts, data)
+            t_export = _timeit(plot_utils.hist_batch, [data], [filename], dpi=100, repeat=1)
+            print(f"{size:>10} {nb_bins:>6} {t_former:>10.4f} {t_counts:>10.4f} {t_export:>10.4f}")
+
+BENCHMARKS = {
+    'dtw': bench_dtw,
+    'write_tdms': bench_write_tdms,
+    'rotations': bench_rotations,
+    'histograms': bench_histograms,
+    'interactive_plotter': bench_interactive_plotter,
+    'hist': bench_hist,
+}
+
+if __name__ == '__main__':
+    for name in sys.argv[1:] or BENCHMARKS:
+        print(f"--- {name} ---")
+        BENCHMARKS[name]()
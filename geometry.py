@@ -1,8 +1,10 @@
 """Geometric helper functions"""
 
 import math
-from random import random
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from random import random, getrandbits
 import numpy as np
+from scipy.spatial import cKDTree
 
 
 def euclidean_distance(p__, q__):
@@ -11,14 +13,150 @@ def euclidean_distance(p__, q__):
     d_y = p__[1] - q__[1]
     return math.sqrt(d_x * d_x + d_y * d_y)
 
-def poisson_disc_sampling(r__, min_x=0, min_y=0, width=1, height=1, k__=30, dist=euclidean_distance, rand=random):
+def _resolve_conflicts(pairs, nb_candidates):
+    """
+    Greedily accept candidates in their order, where a candidate is rejected
+    if it conflicts with an earlier accepted one.
+    Resolved in rounds on the conflicting index pairs (i < j).
+    """
+    state = np.zeros(nb_candidates, dtype=np.int8)  # 0 undecided, 1 accepted, -1 rejected
+    first, second = pairs[:, 0], pairs[:, 1]
+    while True:
+        state[second[(state[first] == 1) & (state[second] == 0)]] = -1
+        undecided = state == 0
+        if not undecided.any():
+            return state == 1
+        blocked = np.zeros(nb_candidates, dtype=bool)
+        blocked[second[state[first] == 0]] = True
+        state[undecided & ~blocked] = 1
+
+def _poisson_disc_sampling_euclidean(
+        r__, min_x, min_y, width, height, k__, rng, batch_size=1024, fixed=None
+    ):
+    """
+    Vectorized variant of poisson_disc_sampling for the euclidean distance.
+    The grid holds indices into a preallocated point buffer. A batch of active points
+    is processed at once, where all k__ candidates are tested in one step against
+    the 5x5 neighborhoods and conflicts between candidates are resolved in random order.
+    Fixed samples outside of the domain, e.g. of neighboring tiles, are respected
+    and used as initial active points, but not returned.
+    """
+    tau = 2 * math.pi
+    cellsize = r__ / math.sqrt(2)
+    r_squared = r__ * r__
+
+    grid_width = int(math.ceil(width / cellsize))
+    grid_height = int(math.ceil(height / cellsize))
+    # Grid is padded by two cells on each side, -1 marks empty cells
+    padded_width = grid_width + 4
+    grid = np.full((grid_height + 4) * padded_width, -1, dtype=np.int64)
+    offset_y, offset_x = np.mgrid[-2:3, -2:3]
+    offsets = (offset_y * padded_width + offset_x).ravel()
+
+    # Fixed samples are kept in the padding, which covers all samples within r__ of the domain
+    fixed = np.empty((0, 2)) if fixed is None else np.asarray(fixed, dtype=float) - [min_x, min_y]
+    fixed_x = np.floor(fixed[:, 0] / cellsize).astype(np.int64) + 2
+    fixed_y = np.floor(fixed[:, 1] / cellsize).astype(np.int64) + 2
+    inside = (fixed_x >= 0) & (fixed_x < padded_width) & (fixed_y >= 0) & (fixed_y < grid_height + 4)
+    nb_fixed = int(np.count_nonzero(inside))
+    points = np.empty((nb_fixed + grid_width * grid_height, 2))
+    queue = np.empty(nb_fixed + grid_width * grid_height, dtype=np.int64)
+    points[:nb_fixed] = fixed[inside]
+    grid[fixed_y[inside] * padded_width + fixed_x[inside]] = np.arange(nb_fixed)
+    queue[:nb_fixed] = np.arange(nb_fixed)
+
+    def grid_cells(p__):
+        """Return flat index into the padded grid of points p__ within the domain"""
+        g_x = np.minimum((p__[:, 0] / cellsize).astype(np.int64), grid_width - 1) + 2
+        g_y = np.minimum((p__[:, 1] / cellsize).astype(np.int64), grid_height - 1) + 2
+        return g_y * padded_width + g_x
+
+    def fits(candidates, cells):
+        """Mask of candidates, which are farther than r__ from all samples in the grid"""
+        # Candidates in occupied cells are always too close, discard them cheaply first
+        free = grid[cells] < 0
+        neighbors = grid[cells[free, None] + offsets]
+        rows, cols = np.nonzero(neighbors >= 0)
+        dist_squared = np.sum((points[neighbors[rows, cols]] - candidates[free][rows])**2, axis=1)
+        mask = free.copy()
+        mask[np.flatnonzero(free)[rows[dist_squared <= r_squared]]] = False
+        return mask
+
+    nb_points = nb_fixed
+    nb_queue = nb_fixed
+    first = np.array([[width * rng.random(), height * rng.random()]])
+    if fits(first, grid_cells(first))[0]:
+        points[nb_points] = first[0]
+        grid[grid_cells(first)] = nb_points
+        queue[nb_queue] = nb_points
+        nb_points += 1
+        nb_queue += 1
+
+    while nb_queue:
+        # Draw active points in random order and remove them from the queue
+        nb_active = min(nb_queue, batch_size)
+        picked = rng.choice(nb_queue, nb_active, replace=False)
+        active = points[queue[picked]]
+        keep = np.ones(nb_queue, dtype=bool)
+        keep[picked] = False
+        queue[:nb_queue - nb_active] = queue[:nb_queue][keep]
+        nb_queue -= nb_active
+
+        alpha = tau * rng.random((nb_active, k__))
+        d__ = r__ * np.sqrt(3 * rng.random((nb_active, k__)) + 1)
+        candidates = np.stack(
+            (active[:, 0:1] + d__ * np.cos(alpha), active[:, 1:2] + d__ * np.sin(alpha)), axis=-1
+        ).reshape(-1, 2)
+        candidates = candidates[
+            (candidates[:, 0] >= 0) & (candidates[:, 0] < width)
+            & (candidates[:, 1] >= 0) & (candidates[:, 1] < height)
+        ]
+        if not len(candidates):
+            continue
+        cells = grid_cells(candidates)
+        mask = fits(candidates, cells)
+        candidates, cells = candidates[mask], cells[mask]
+        if not len(candidates):
+            continue
+
+        # Candidates within the batch may still conflict with each other
+        pairs = cKDTree(candidates).query_pairs(r__, output_type='ndarray')
+        if len(pairs):
+            accepted = _resolve_conflicts(pairs, len(candidates))
+            candidates, cells = candidates[accepted], cells[accepted]
+        indices = np.arange(nb_points, nb_points + len(candidates))
+        points[indices] = candidates
+        grid[cells] = indices
+        queue[nb_queue:nb_queue + len(indices)] = indices
+        nb_points += len(indices)
+        nb_queue += len(indices)
+
+    grid = grid.reshape(grid_height + 4, padded_width)
+    indices = grid[2:-2, 2:-2].ravel()
+    return points[indices[indices >= nb_fixed]] + [min_x, min_y]
+
+def poisson_disc_sampling(
+        r__, min_x=0, min_y=0, width=1, height=1, k__=30, dist=euclidean_distance, rand=random,
+        rng=None
+    ):
     """
     Calculate Poisson Disk Sampling based on Robert Bridson's algorithm.
+    With the default dist and rand, a vectorized implementation is used,
+    which draws from the numpy.random.Generator (or seed) rng for reproducibility.
+    If rng is None, it is seeded from the random module, so random.seed(...) still
+    gives reproducible samples, which however differ from those of former versions.
+    Custom dist or rand functions are evaluated per candidate and neighbor.
 
     References:
         - https://www.cs.ubc.ca/~rbridson/docs/bridson-siggraph07-poissondisk.pdf
         - https://github.com/emulbreh/bridson
     """
+    if dist is euclidean_distance and rand is random:
+        if rng is None:
+            rng = getrandbits(64)
+        return _poisson_disc_sampling_euclidean(
+            r__, min_x, min_y, width, height, k__, np.random.default_rng(rng)
+        )
     tau = 2 * math.pi
     cellsize = r__ / math.sqrt(2)
 
@@ -70,6 +208,278 @@ def poisson_disc_sampling(r__, min_x=0, min_y=0, width=1, height=1, k__=30, dist
             grid[grid_x + grid_y * grid_width] = p__
     return np.array([np.array(p__) + [min_x, min_y] for p__ in grid if p__ is not None])
 
+def _poisson_disc_tile(r__, bounds, k__, seed, fixed):
+    """Sample one tile, respecting the border samples of finished neighboring tiles"""
+    x_0, y_0, x_1, y_1 = bounds
+    return _poisson_disc_sampling_euclidean(
+        r__, x_0, y_0, x_1 - x_0, y_1 - y_0, k__, np.random.default_rng(seed), fixed=fixed
+    )
+
+def iter_poisson_disc_tiles(
+        r__, min_x=0, min_y=0, width=1, height=1, tile_size=1, k__=30, seed=None, workers=None
+    ):
+    """
+    Generator for Poisson Disk Sampling of large domains, which are split into tiles.
+    Tiles are generated in four phases of a checkerboard pattern, such that tiles
+    of the same phase are not adjacent and can be sampled in parallel.
+    Each tile respects the samples of its neighbors from previous phases,
+    which are within r__ of its border, so the disc constraint holds across seams.
+    Only these border samples are kept, finished tiles are handed to the caller.
+
+    Args:
+        tile_size: edge length of the tiles, has to be larger than r__
+        seed: seed for the per-tile random generators, results do not depend on workers
+        workers: number of processes, 1 samples in the calling process
+    Yields:
+        tile indices (tile_x, tile_y) and numpy array of the tile samples
+    """
+    if tile_size <= r__:
+        raise ValueError("tile_size has to be larger than r__")
+    nb_tiles_x = int(math.ceil(width / tile_size))
+    nb_tiles_y = int(math.ceil(height / tile_size))
+    entropy = np.random.SeedSequence(seed).entropy
+    borders = {}
+
+    def bounds(t_x, t_y):
+        """Domain of tile"""
+        x_0, y_0 = min_x + t_x * tile_size, min_y + t_y * tile_size
+        return x_0, y_0, min(x_0 + tile_size, min_x + width), min(y_0 + tile_size, min_y + height)
+
+    def task(t_x, t_y):
+        """Arguments of _poisson_disc_tile"""
+        fixed = [
+            borders[(t_x + d_x, t_y + d_y)]
+            for d_x in (-1, 0, 1) for d_y in (-1, 0, 1)
+            if (t_x + d_x, t_y + d_y) in borders
+        ]
+        fixed = np.concatenate(fixed) if fixed else None
+        return r__, bounds(t_x, t_y), k__, [entropy, t_x, t_y], fixed
+
+    def finish(t_x, t_y, points):
+        """Keep samples within r__ of the tile border for the neighbors"""
+        x_0, y_0, x_1, y_1 = bounds(t_x, t_y)
+        near = (
+            (points[:, 0] < x_0 + r__) | (points[:, 0] >= x_1 - r__)
+            | (points[:, 1] < y_0 + r__) | (points[:, 1] >= y_1 - r__)
+        )
+        borders[(t_x, t_y)] = points[near]
+
+    executor = ProcessPoolExecutor(max_workers=workers) if workers != 1 else None
+    try:
+        for phase_x, phase_y in ((0, 0), (1, 0), (0, 1), (1, 1)):
+            tiles = [
+                (t_x, t_y)
+                for t_y in range(phase_y, nb_tiles_y, 2)
+                for t_x in range(phase_x, nb_tiles_x, 2)
+            ]
+            if executor is None:
+                for t_x, t_y in tiles:
+                    points = _poisson_disc_tile(*task(t_x, t_y))
+                    finish(t_x, t_y, points)
+                    yield t_x, t_y, points
+                continue
+            futures = {executor.submit(_poisson_disc_tile, *task(*tile)): tile for tile in tiles}
+            for future in as_completed(futures):
+                t_x, t_y = futures[future]
+                points = future.result()
+                finish(t_x, t_y, points)
+                yield t_x, t_y, points
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+
+def poisson_disc_sampling_tiled(
+        r__, min_x=0, min_y=0, width=1, height=1, tile_size=1, k__=30, seed=None, workers=None,
+        filename=None
+    ):
+    """
+    Poisson Disk Sampling of large domains using iter_poisson_disc_tiles.
+    If filename is given, the samples are written tile by tile to this raw float64 file
+    and returned as read-only numpy.memmap of shape (n, 2).
+    """
+    tiles = iter_poisson_disc_tiles(r__, min_x, min_y, width, height, tile_size, k__, seed, workers)
+    if filename is None:
+        return np.concatenate([points for __, __, points in tiles])
+    nb_points = 0
+    with open(filename, 'wb') as f_handle:
+        for __, __, points in tiles:
+            f_handle.write(np.ascontiguousarray(points, dtype=np.float64).tobytes())
+            nb_points += len(points)
+    return np.memmap(filename, dtype=np.float64, mode='r', shape=(nb_points, 2))
+
+def validate_poisson_disc(points, r__, tile_size=None, min_x=0, min_y=0):
+    """
+    Check that no two samples are within distance r__ using a KD-tree.
+    If tile_size is given, only samples within r__ of the tile seams are checked.
+    """
+    points = np.asarray(points)
+    if tile_size is not None:
+        local = np.mod(points - [min_x, min_y], tile_size)
+        points = points[np.any((local < r__) | (local >= tile_size - r__), axis=1)]
+    return len(cKDTree(points).query_pairs(r__, output_type='ndarray')) == 0
+
+def _radius_field(radius, lower, upper):
+    """Return vectorized radius function from a constant, a callable or a raster over the bounds"""
+    if callable(radius):
+        return lambda p__: np.broadcast_to(np.asarray(radius(p__), dtype=float), (len(p__),))
+    raster = np.asarray(radius, dtype=float)
+    if raster.ndim == 0:
+        return lambda p__: np.full(len(p__), float(raster))
+    shape = np.array(raster.shape)
+
+    def sample(p__):
+        """Nearest raster cell of each point"""
+        index = ((p__ - lower) / (upper - lower) * shape).astype(np.int64)
+        index = np.clip(index, 0, shape - 1)
+        return raster[tuple(index.T)]
+
+    return sample
+
+class _RadiusLevel:
+    """
+    Background grid for samples with radius in [2**level, 2**(level + 1)).
+    The cell diagonal equals the smallest radius, hence each cell holds at most one sample.
+    The grid is padded, so neighborhoods of pad cells never leave it.
+    """
+    def __init__(self, level, lower, upper):
+        dim = len(lower)
+        self.lower = lower
+        self.r_max = 2.0**(level + 1)
+        self.cellsize = 2.0**level / math.sqrt(dim)
+        self.pad = int(math.ceil(self.r_max / self.cellsize))
+        self.nb_cells = np.ceil((upper - lower) / self.cellsize).astype(np.int64)
+        shape = self.nb_cells + 2 * self.pad
+        self.strides = np.cumprod(np.concatenate(([1], shape[:0:-1])))[::-1]
+        self.grid = np.full(int(np.prod(shape)), -1, dtype=np.int64)
+        self.offsets = {}
+
+    def cells(self, p__):
+        """Flat index into the padded grid of points p__"""
+        index = np.minimum(((p__ - self.lower) / self.cellsize).astype(np.int64), self.nb_cells - 1)
+        return (index + self.pad) @ self.strides
+
+    def neighborhood(self, reach):
+        """Flat offsets of all cells within reach cells along each axis"""
+        if reach not in self.offsets:
+            axes = np.meshgrid(*[np.arange(-reach, reach + 1)] * len(self.strides), indexing='ij')
+            self.offsets[reach] = np.stack([axis.ravel() for axis in axes], axis=1) @ self.strides
+        return self.offsets[reach]
+
+def poisson_disc_sampling_nd(radius, lower, upper, k__=30, rng=None, batch_size=1024):
+    """
+    Calculate N-dimensional Poisson Disk Sampling with variable radius
+    based on Robert Bridson's algorithm.
+    Two samples p and q are more than min(r(p), r(q)) apart.
+    Samples are stored in one background grid per power of two of the radius,
+    so neighbor checks stay bounded when radii vary by orders of magnitude.
+
+    References:
+        - https://www.cs.ubc.ca/~rbridson/docs/bridson-siggraph07-poissondisk.pdf
+
+    Args:
+        radius: constant radius, callable mapping points of shape (n, d) to radii
+            or raster array with d dimensions, which spans the bounds
+        lower: lower corner of the sampling domain
+        upper: upper corner of the sampling domain
+        k__: number of candidates per active sample
+        rng: numpy.random.Generator or seed
+        batch_size: number of active samples, whose candidates are tested at once
+    Returns:
+        numpy array of shape (n, d)
+    """
+    rng = np.random.default_rng(rng)
+    lower = np.asarray(lower, dtype=float)
+    upper = np.asarray(upper, dtype=float)
+    dim = len(lower)
+    radius_at = _radius_field(radius, lower, upper)
+    levels = {}
+
+    def get_level(level):
+        """Return background grid of level, generate it on first use"""
+        if level not in levels:
+            levels[level] = _RadiusLevel(level, lower, upper)
+        return levels[level]
+
+    points = np.empty((1024, dim))
+    radii = np.empty(1024)
+    queue = [0]
+    points[0] = lower + (upper - lower) * rng.random(dim)
+    radii[0] = radius_at(points[:1])[0]
+    level = int(math.floor(math.log2(radii[0])))
+    get_level(level).grid[get_level(level).cells(points[:1])] = 0
+    nb_points = 1
+
+    while queue:
+        picked = rng.choice(len(queue), min(len(queue), batch_size), replace=False)
+        active = np.array(queue)[picked]
+        queue = list(np.delete(np.array(queue, dtype=np.int64), picked))
+
+        # Uniform directions and distances within the shell [r, 2r] of each active sample
+        directions = rng.normal(size=(len(active), k__, dim))
+        directions /= np.linalg.norm(directions, axis=2, keepdims=True)
+        shell = (1 + rng.random((len(active), k__)) * (2**dim - 1))**(1 / dim)
+        candidates = points[active][:, None, :] + (
+            directions * (radii[active][:, None] * shell)[:, :, None]
+        )
+        candidates = candidates.reshape(-1, dim)
+        candidates = candidates[np.all((candidates >= lower) & (candidates < upper), axis=1)]
+        if not len(candidates):
+            continue
+        cand_radii = radius_at(candidates)
+        cand_levels = np.floor(np.log2(cand_radii)).astype(np.int64)
+
+        # Candidates in occupied cells of their own level are always too close
+        fits = np.ones(len(candidates), dtype=bool)
+        for level in np.unique(cand_levels):
+            mask = cand_levels == level
+            fits[mask] = get_level(level).grid[get_level(level).cells(candidates[mask])] < 0
+        candidates, cand_radii, cand_levels = candidates[fits], cand_radii[fits], cand_levels[fits]
+
+        fits = np.ones(len(candidates), dtype=bool)
+        for grid_level in levels.values():
+            reach = int(math.ceil(min(cand_radii.max(initial=0), grid_level.r_max) / grid_level.cellsize))
+            offsets = grid_level.neighborhood(reach)
+            cells = grid_level.cells(candidates)
+            chunk = max(1, 2**22 // len(offsets))
+            for start in range(0, len(candidates), chunk):
+                neighbors = grid_level.grid[cells[start:start + chunk, None] + offsets]
+                rows, cols = np.nonzero(neighbors >= 0)
+                neighbors = neighbors[rows, cols]
+                rows += start
+                dist_squared = np.sum((points[neighbors] - candidates[rows])**2, axis=1)
+                min_radii = np.minimum(cand_radii[rows], radii[neighbors])
+                fits[rows[dist_squared <= min_radii**2]] = False
+        candidates, cand_radii, cand_levels = candidates[fits], cand_radii[fits], cand_levels[fits]
+        if not len(candidates):
+            continue
+
+        # Candidates within the batch may still conflict with each other
+        pairs = cKDTree(candidates).query_pairs(cand_radii.max(), output_type='ndarray')
+        if len(pairs):
+            dist_squared = np.sum((candidates[pairs[:, 0]] - candidates[pairs[:, 1]])**2, axis=1)
+            min_radii = np.minimum(cand_radii[pairs[:, 0]], cand_radii[pairs[:, 1]])
+            pairs = pairs[dist_squared <= min_radii**2]
+        if len(pairs):
+            accepted = _resolve_conflicts(pairs, len(candidates))
+            candidates, cand_radii, cand_levels = (
+                candidates[accepted], cand_radii[accepted], cand_levels[accepted]
+            )
+
+        if nb_points + len(candidates) > len(points):
+            capacity = max(2 * len(points), nb_points + len(candidates))
+            points = np.resize(points, (capacity, dim))
+            radii = np.resize(radii, capacity)
+        indices = np.arange(nb_points, nb_points + len(candidates))
+        points[indices] = candidates
+        radii[indices] = cand_radii
+        for level in np.unique(cand_levels):
+            mask = cand_levels == level
+            get_level(level).grid[get_level(level).cells(candidates[mask])] = indices[mask]
+        queue.extend(indices.tolist())
+        nb_points += len(indices)
+
+    return points[:nb_points]
+
 def rotation_matrix(axis, theta):
     """
     Return the rotation matrix associated with counterclockwise rotation about
@@ -99,6 +509,99 @@ def rotation_matrix(axis, theta):
         ]
     )
 
+def rotation_matrices(axes, thetas):
+    """
+    Batched version of rotation_matrix.
+
+    Args:
+        axes: rotation axes of shape (n, 3) or one axis of shape (3,) for all angles
+        thetas: rotation angles of shape (n,)
+
+    Returns:
+        Numpy array of shape (n, 3, 3).
+    """
+    return quaternion_matrices(axis_angle_quaternions(axes, thetas))
+
+def axis_angle_quaternions(axes, thetas):
+    """Unit quaternions (w, x, y, z) of shape (n, 4) for rotations about axes by thetas radians"""
+    axes = np.asarray(axes, dtype=float)
+    thetas = np.asarray(thetas, dtype=float)
+    axes = axes / np.linalg.norm(axes, axis=-1, keepdims=True)
+    half = thetas / 2.0
+    shape = np.broadcast_shapes(axes.shape[:-1], half.shape)
+    quats = np.empty(shape + (4,))
+    quats[..., 0] = np.cos(half)
+    quats[..., 1:] = axes * np.sin(half)[..., None]
+    return quats
+
+def quaternion_multiply(quats1, quats2):
+    """
+    Hamilton product of quaternions (w, x, y, z) with broadcasting.
+    The resulting rotation applies quats2 first and quats1 second.
+    """
+    quats1, quats2 = np.asarray(quats1, dtype=float), np.asarray(quats2, dtype=float)
+    w_1, x_1, y_1, z_1 = np.moveaxis(quats1, -1, 0)
+    w_2, x_2, y_2, z_2 = np.moveaxis(quats2, -1, 0)
+    return np.stack(
+        [
+            w_1 * w_2 - x_1 * x_2 - y_1 * y_2 - z_1 * z_2,
+            w_1 * x_2 + x_1 * w_2 + y_1 * z_2 - z_1 * y_2,
+            w_1 * y_2 - x_1 * z_2 + y_1 * w_2 + z_1 * x_2,
+            w_1 * z_2 + x_1 * y_2 - y_1 * x_2 + z_1 * w_2
+        ],
+        axis=-1
+    )
+
+def quaternion_matrices(quats):
+    """
+    Rotation matrices of shape (n, 3, 3) of quaternions (w, x, y, z).
+    Quaternions do not need to be normalized, e.g. after chaining
+    multiple axes with quaternion_multiply, since the norm is divided out here.
+    """
+    quats = np.asarray(quats, dtype=float)
+    w__, x__, y__, z__ = np.moveaxis(quats, -1, 0)
+    scale = 2.0 / np.sum(quats**2, axis=-1)
+    x_s, y_s, z_s = x__ * scale, y__ * scale, z__ * scale
+    w_x, w_y, w_z = w__ * x_s, w__ * y_s, w__ * z_s
+    x_x, x_y, x_z = x__ * x_s, x__ * y_s, x__ * z_s
+    y_y, y_z, z_z = y__ * y_s, y__ * z_s, z__ * z_s
+    matrices = np.empty(quats.shape[:-1] + (3, 3))
+    matrices[..., 0, 0] = 1.0 - (y_y + z_z)
+    matrices[..., 0, 1] = x_y - w_z
+    matrices[..., 0, 2] = x_z + w_y
+    matrices[..., 1, 0] = x_y + w_z
+    matrices[..., 1, 1] = 1.0 - (x_x + z_z)
+    matrices[..., 1, 2] = y_z - w_x
+    matrices[..., 2, 0] = x_z - w_y
+    matrices[..., 2, 1] = y_z + w_x
+    matrices[..., 2, 2] = 1.0 - (x_x + y_y)
+    return matrices
+
+def rotate_points(points, matrices, per_sample=True, out=None):
+    """
+    Apply stack of rotation matrices of shape (n, 3, 3) to points.
+
+    Args:
+        points: if per_sample, array of shape (n, ..., 3), where sample i is rotated by matrices[i],
+            otherwise point cloud of shape (..., 3), which is rotated by every matrix
+        matrices: rotation matrices of shape (n, 3, 3)
+        per_sample: pair points and matrices along the first axis
+        out: optional output array of shape (n, ..., 3)
+    """
+    points = np.asarray(points, dtype=float)
+    transposed = np.swapaxes(matrices, -1, -2)
+    if per_sample:
+        shape = points.shape
+        points = points.reshape(len(points), -1, 3)
+    else:
+        shape = (len(matrices),) + points.shape
+        points = points.reshape(-1, 3)
+    if out is None:
+        out = np.empty(shape)
+    # Row vectors are rotated by multiplication with the transposed matrices
+    np.matmul(points, transposed, out=out.reshape(len(matrices), -1, 3))
+    return out
+
 def largest_area_in_histogram(histogram):
     """
     This function calulates maximum
@@ -164,38 +667,151 @@ def largest_area_in_histogram(histogram):
     # the given histogram
     return max_area, left, right, height
 
-def max_rectangle(grid):
+def _nearest_lower(histograms, strict):
+    """
+    Index of the nearest bar to the left of each bar in every row of histograms,
+    which is lower (strict) or lower or equal (not strict) than the bar, -1 if there is none.
+    All bars follow their chain of candidates by pointer jumping simultaneously,
+    where each vectorized round only touches the bars which are not resolved yet.
     """
-    Find the rectangle of maximum area size using multiple calls of largest_area_in_histogram
+    nb_rows, width = histograms.shape
+    # Column 0 of each row is a sentinel lower than all bars, bar i is stored in column i + 1
+    padded = np.empty((nb_rows, width + 1))
+    padded[:, 0] = -np.inf
+    padded[:, 1:] = histograms
+    padded = padded.ravel()
+    nearest = np.arange(nb_rows * (width + 1)) - 1
+    nearest[::width + 1] += 1
+    active = np.flatnonzero(np.arange(nb_rows * (width + 1)) % (width + 1))
+    while len(active):
+        candidate = padded[nearest[active]]
+        bars = padded[active]
+        active = active[candidate >= bars if strict else candidate > bars]
+        nearest[active] = nearest[nearest[active]]
+    return (nearest % (width + 1)).reshape(nb_rows, width + 1)[:, 1:] - 1
+
+def largest_area_in_histograms(histograms):
+    """
+    Batched version of largest_area_in_histogram for a 2-D array with one histogram per row,
+    with the same choice among rectangles of equal area.
+    Nearest lower bars to the left and right are found for all rows at once,
+    so the interpreter overhead is shared by all histograms.
+
+    Returns:
+        Arrays of max_area, left, right and height (bar height - 1) per row.
+    """
+    histograms = np.asarray(histograms, dtype=float)
+    nb_rows, width = histograms.shape
+    # largest_area_in_histogram bounds each bar by the nearest lower or equal bar to the left
+    # and the nearest strictly lower bar to the right, which pops it from the stack
+    left = _nearest_lower(histograms, strict=False)
+    right = width - 1 - _nearest_lower(histograms[:, ::-1], strict=True)[:, ::-1]
+    areas = histograms * (right - left - 1)
+    max_area = areas.max(axis=1, initial=0)
+    # Bars are popped in order of their right bound and from the top of the stack,
+    # the first bar reaching the maximum wins
+    order = np.where(areas == max_area[:, None], right * (width + 1) - np.arange(width), np.inf)
+    winner = np.argmin(order, axis=1)
+    rows = np.arange(nb_rows)
+    found = max_area > 0
+    return (
+        max_area,
+        np.where(found, left[rows, winner] + 1, -1),
+        np.where(found, right[rows, winner] - 1, -1),
+        np.where(found, histograms[rows, winner] - 1, -1).astype(np.int64)
+    )
+
+def _bar_heights(grid, above=None):
+    """
+    Heights of consecutive cells with grid > 0 ending in each cell of the rows of grid,
+    continuing the heights of the row above, if given
+    """
+    occupied = np.asarray(grid) > 0
+    nb_rows = len(occupied)
+    rows = np.arange(1, nb_rows + 1)[:, None]
+    # Row of the last empty cell above each cell by cumulative maximum
+    last_empty = np.maximum.accumulate(np.where(occupied, 0, rows), axis=0)
+    heights = rows - last_empty
+    if above is not None:
+        heights = np.where(last_empty == 0, heights + above, heights)
+    return heights
+
+def max_rectangle(grid, block_size=256):
+    """
+    Find the rectangle of maximum area size of cells with grid > 0
+    using row-wise histograms of consecutive cells.
+    Histograms are built by cumulative operations and evaluated for blocks of rows at once.
 
     References:
         - https://www.geeksforgeeks.org/maximum-size-rectangle-binary-sub-matrix-1s/
+
+    Returns:
+        [bottom, left] and [top, right] indices of the rectangle, where bottom <= top
     """
-    nb_cells = len(grid)
-    counts = np.zeros((nb_cells, nb_cells))
-    for row in range(nb_cells):
-        for col in range(nb_cells):
-            if grid[row, col] > 0:
-                counts[row, col] = 1
-    result, left, right, height = largest_area_in_histogram(counts[0])
-    bottom = 0
-    for row in range(nb_cells):
-        for col in range(nb_cells):
-            nb_points = grid[row, col]
-            if nb_points > 0:
-                counts[row, col] = counts[row - 1, col] + 1
-        local_result, local_left, local_right, local_height = largest_area_in_histogram(counts[row])
-        if local_result > result:
-            result = local_result
-            left = local_left
-            right = local_right
-            height = local_height
-            bottom = row - local_height
+    grid = np.asarray(grid)
+    heights = None
+    result, left, right, height, bottom = 0, -1, -1, -1, 0
+    for start in range(0, len(grid), block_size):
+        above = None if heights is None else heights[-1]
+        heights = _bar_heights(grid[start:start + block_size], above)
+        areas, lefts, rights, local_heights = largest_area_in_histograms(heights)
+        row = int(np.argmax(areas))
+        if areas[row] > result:
+            result = areas[row]
+            left, right, height = int(lefts[row]), int(rights[row]), int(local_heights[row])
+            bottom = start + row - height
     max_index = [height + bottom, right]
     min_index = [bottom, left]
 
     return min_index, max_index
 
+class MaxRectangle:
+    """
+    Maximum rectangle of cells with grid > 0 like max_rectangle,
+    which is updated incrementally when rows of the grid change.
+    Histogram heights and the best rectangle per row are cached,
+    only rows whose heights change are re-evaluated.
+    """
+    def __init__(self, grid, block_size=64):
+        self.grid = np.array(grid)
+        self.block_size = block_size
+        self.heights = _bar_heights(self.grid)
+        self.rows = list(largest_area_in_histograms(self.heights))
+
+    def update(self, rows, values):
+        """Replace grid rows by values and update the cached histograms"""
+        rows = np.atleast_1d(rows)
+        self.grid[rows] = values
+        first = int(rows.min())
+        last = int(rows.max())
+        above = self.heights[first - 1] if first > 0 else None
+        heights = _bar_heights(self.grid[first:last + 1], above)
+        # Heights below the changed rows only change until a row of heights matches again
+        stop = last + 1
+        while stop < len(self.grid) and not np.array_equal(self.heights[stop - 1], heights[-1]):
+            block = _bar_heights(self.grid[stop:stop + self.block_size], heights[-1])
+            same = np.all(block == self.heights[stop:stop + len(block)], axis=1)
+            if same.any():
+                block = block[:np.argmax(same)]
+            heights = np.concatenate((heights, block))
+            stop += len(block)
+            if same.any():
+                break
+        changed = first + np.flatnonzero(np.any(heights != self.heights[first:stop], axis=1))
+        self.heights[first:stop] = heights
+        if len(changed):
+            for cache, values in zip(self.rows, largest_area_in_histograms(self.heights[changed])):
+                cache[changed] = values
+
+    def result(self):
+        """Return [bottom, left] and [top, right] indices like max_rectangle"""
+        areas, lefts, rights, heights = self.rows
+        row = int(np.argmax(areas))
+        if areas[row] <= 0:
+            return [0, -1], [-1, -1]
+        bottom = row - int(heights[row])
+        return [bottom, int(lefts[row])], [int(heights[row]) + bottom, int(rights[row])]
+
 def ar_h(u):
     if u >= 1: return np.pi
     elif u > -1: return np.pi - np.arccos(u) + u * np.sqrt(1 - u**2)
@@ -222,4 +838,157 @@ def ar_area(r, xc, yc, x0, y0, x1, y1):
     """
     return r**2 * ar_rect((x0-xc)/r, (y0-yc)/r, (x1-xc)/r, (y1-yc)/r)
 
+def ar_h_array(u):
+    """Array version of ar_h"""
+    u = np.asarray(u, dtype=float)
+    inner = np.clip(u, -1, 1)
+    return np.select(
+        [u >= 1, u > -1],
+        [np.pi, np.pi - np.arccos(inner) + inner * np.sqrt(1 - inner**2)],
+        0.0
+    )
+
+def ar_quad_array(u, v):
+    """Array version of ar_quad with broadcasting of u and v"""
+    u, v = np.broadcast_arrays(np.asarray(u, dtype=float), np.asarray(v, dtype=float))
+    h_u, h_v = ar_h_array(u), ar_h_array(v)
+    # Conditions in the same order as the branches of ar_quad, the first match wins
+    return np.select(
+        [
+            u**2 + v**2 <= 1,
+            (u <= -1) | (v <= -1),
+            (u >= 1) & (v >= 1),
+            u >= 1,
+            v >= 1,
+            (u >= 0) & (v >= 0),
+            (u >= 0) & (v <= 0),
+            (u <= 0) & (v >= 0)
+        ],
+        [
+            (h_u + h_v)/2 - np.pi/4 + u*v,
+            0.0,
+            np.pi,
+            h_v,
+            h_u,
+            h_u + h_v - np.pi,
+            h_v,
+            h_u
+        ],
+        0.0
+    )
+
+def ar_rect_array(x0, y0, x1, y1):
+    """Array version of ar_rect"""
+    return ar_quad_array(x0, y0) + ar_quad_array(x1, y1) - ar_quad_array(x0, y1) - ar_quad_array(x1, y0)
+
+def ar_area_array(r, xc, yc, x0, y0, x1, y1):
+    """
+    Array version of ar_area, all arguments are broadcast against each other,
+    e.g. many circles against many rectangles.
+    """
+    r = np.asarray(r, dtype=float)
+    return r**2 * ar_rect_array((x0-xc)/r, (y0-yc)/r, (x1-xc)/r, (y1-yc)/r)
+
+def ar_area_grid(r, xc, yc, x_edges, y_edges, precheck=True):
+    """
+    Calculate the intersection area between a circle with center point (xc, yc) and radius r
+    and every cell of a grid given by its ascending cell edges.
+    With precheck, only cells cut by the circle are evaluated by ar_area_array,
+    cells outside of the circle are 0 and cells inside get their full area.
+
+    Returns:
+        Numpy array of shape (len(y_edges) - 1, len(x_edges) - 1).
+    """
+    x_edges = np.asarray(x_edges, dtype=float)
+    y_edges = np.asarray(y_edges, dtype=float)
+    if not precheck:
+        return ar_area_array(
+            r, xc, yc, x_edges[None, :-1], y_edges[:-1, None], x_edges[None, 1:], y_edges[1:, None]
+        )
+
+    area = np.zeros((len(y_edges) - 1, len(x_edges) - 1))
+    # Only cells overlapping the bounding box of the circle can intersect it
+    col_0 = max(np.searchsorted(x_edges, xc - r, side='right') - 1, 0)
+    col_1 = min(np.searchsorted(x_edges, xc + r, side='left'), len(x_edges) - 1)
+    row_0 = max(np.searchsorted(y_edges, yc - r, side='right') - 1, 0)
+    row_1 = min(np.searchsorted(y_edges, yc + r, side='left'), len(y_edges) - 1)
+    if col_0 >= col_1 or row_0 >= row_1:
+        return area
+    x0, x1 = x_edges[None, col_0:col_1], x_edges[None, col_0 + 1:col_1 + 1]
+    y0, y1 = y_edges[row_0:row_1, None], y_edges[row_0 + 1:row_1 + 1, None]
+
+    # Farthest and nearest point of each cell to the circle center
+    far_x = np.maximum(np.abs(x0 - xc), np.abs(x1 - xc))
+    far_y = np.maximum(np.abs(y0 - yc), np.abs(y1 - yc))
+    near_x = np.clip(xc, x0, x1) - xc
+    near_y = np.clip(yc, y0, y1) - yc
+    inside = far_x**2 + far_y**2 <= r**2
+    cut = ~inside & (near_x**2 + near_y**2 < r**2)
+
+    block = area[row_0:row_1, col_0:col_1]
+    block[inside] = np.broadcast_to((x1 - x0) * (y1 - y0), block.shape)[inside]
+    rows, cols = np.nonzero(cut)
+    block[rows, cols] = ar_area_array(r, xc, yc, x0[0, cols], y0[rows, 0], x1[0, cols], y1[rows, 0])
+    return area
+
+class EngagementTracker:
+    """
+    Incremental material removal of a circular cutter moving over a discretized workpiece.
+    The remaining material is kept as float32 fill fraction per cell, which is assumed
+    to be distributed uniformly within the cell. Each step only touches the cells
+    within the bounding box of the cutter.
+    """
+    def __init__(self, x_edges, y_edges, fill=None, depth=1.0):
+        """
+        Args:
+            x_edges: ascending cell edges along x
+            y_edges: ascending cell edges along y
+            fill: initial fill fractions of shape (len(y_edges) - 1, len(x_edges) - 1), full if None
+            depth: axial depth of cut, which converts removed area into volume
+        """
+        self.x_edges = np.asarray(x_edges, dtype=float)
+        self.y_edges = np.asarray(y_edges, dtype=float)
+        shape = (len(self.y_edges) - 1, len(self.x_edges) - 1)
+        self.fill = np.ones(shape, dtype=np.float32) if fill is None else np.array(fill, dtype=np.float32)
+        self.cell_area = np.outer(np.diff(self.y_edges), np.diff(self.x_edges))
+        self.depth = depth
 
+    def _bbox(self, x_min, y_min, x_max, y_max):
+        """Row and column slices of the cells overlapping the given box"""
+        col_0 = max(np.searchsorted(self.x_edges, x_min, side='right') - 1, 0)
+        col_1 = min(np.searchsorted(self.x_edges, x_max, side='left'), len(self.x_edges) - 1)
+        row_0 = max(np.searchsorted(self.y_edges, y_min, side='right') - 1, 0)
+        row_1 = min(np.searchsorted(self.y_edges, y_max, side='left'), len(self.y_edges) - 1)
+        return slice(row_0, max(row_0, row_1)), slice(col_0, max(col_0, col_1))
+
+    def step(self, xc, yc, r):
+        """
+        Move cutter to (xc, yc) and remove the material within radius r.
+
+        Returns:
+            Engaged area and removed volume.
+        """
+        rows, cols = self._bbox(xc - r, yc - r, xc + r, yc + r)
+        intersection = ar_area_grid(
+            r, xc, yc,
+            self.x_edges[cols.start:cols.stop + 1], self.y_edges[rows.start:rows.stop + 1]
+        )
+        fill = self.fill[rows, cols]
+        area = float(np.sum(fill * intersection))
+        fill *= 1 - intersection / self.cell_area[rows, cols]
+        np.maximum(fill, 0, out=fill)
+        return area, area * self.depth
+
+    def process_path(self, xc, yc, r):
+        """
+        Move cutter along path positions xc, yc (r may vary per step),
+        which is a plain loop over step, as each step only touches its own bounding box.
+
+        Returns:
+            Arrays of engaged area and removed volume per step.
+        """
+        xc, yc, r = np.broadcast_arrays(
+            np.asarray(xc, dtype=float), np.asarray(yc, dtype=float), np.asarray(r, dtype=float)
+        )
+        areas = np.array([self.step(x_c, y_c, radius)[0] for x_c, y_c, radius in zip(xc, yc, r)])
+        return areas, areas * self.depth
@@ -1,12 +1,19 @@
 """Miscellaneous methods"""
 
 import os
+import mmap
+import json
+import contextlib
+import locale
+import pickle
 import hashlib
 import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from tempfile import mkstemp
-from shutil import move
-import gdown
+import shutil
+import numpy as np
 
 
 def to_local_dir(filehandle):  # needs __file__ from caller
@@ -22,53 +29,186 @@ def gen_dirs(directories):
             except OSError:
                 print(f"Error: Creation of directory {directory} failed.")
 
-def md5sum(filename, blocksize=65536):
-    """Generate md5 sum"""
-    hsh = hashlib.md5()
-    with open(filename, 'rb') as f_handle:
-        for block in iter(lambda: f_handle.read(blocksize), b''):
-            hsh.update(block)
+def file_hash(filename, algorithm='md5', blocksize=2**22):
+    """Generate hex digest of file with any hashlib algorithm, e.g. 'md5' or 'blake2b'"""
+    hsh = hashlib.new(algorithm)
+    buffer = bytearray(blocksize)
+    view = memoryview(buffer)
+    with open(filename, 'rb', buffering=0) as f_handle:
+        while True:
+            nb_bytes = f_handle.readinto(buffer)
+            if not nb_bytes:
+                break
+            hsh.update(view[:nb_bytes])
     return hsh.hexdigest()
 
+def md5sum(filename, blocksize=2**22):
+    """Generate md5 sum"""
+    return file_hash(filename, 'md5', blocksize)
 
-def cached_download(url, path, md5=None, quiet=False):
+class HashIndex:
+    """
+    Persistent index of file digests, which are only recomputed
+    if size or modification time of a file changed.
+    """
+    def __init__(self, pathname):
+        self.pathname = pathname
+        self.lock = threading.Lock()
+        try:
+            with open(pathname) as f_handle:
+                self.entries = json.load(f_handle)
+        except (OSError, ValueError):
+            self.entries = {}
+
+    def digest(self, filename, algorithm='md5'):
+        """Return digest of file, hash it only if it is not indexed or changed"""
+        filename = os.path.realpath(filename)
+        stat = os.stat(filename)
+        key = f'{filename}:{algorithm}'
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry is not None and entry[:2] == [stat.st_size, stat.st_mtime_ns]:
+            return entry[2]
+        digest = file_hash(filename, algorithm)
+        with self.lock:
+            self.entries[key] = [stat.st_size, stat.st_mtime_ns, digest]
+        return digest
+
+    def save(self):
+        """
+        Write index atomically.
+        Failures are not fatal, as the index only saves hashing again.
+
+        Returns:
+            True if the index has been written
+        """
+        directory = os.path.dirname(os.path.abspath(self.pathname))
+        tmp_path = None
+        try:
+            os.makedirs(directory, exist_ok=True)
+            f_h, tmp_path = mkstemp(dir=directory)
+            with self.lock, os.fdopen(f_h, 'w') as f_handle:
+                json.dump(self.entries, f_handle)
+            os.replace(tmp_path, self.pathname)
+        except OSError as error:
+            print(f"Error: Saving hash index {self.pathname} failed ({error}).")
+            if tmp_path is not None and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return False
+        return True
+
+DEFAULT_HASH_INDEX = os.path.join(os.path.expanduser('~'), '.cache', 'pylib', 'hash_index.json')
+
+@functools.lru_cache(maxsize=None)
+def get_hash_index(pathname=DEFAULT_HASH_INDEX):
+    """Return shared HashIndex instance of index file"""
+    return HashIndex(pathname)
+
+def hash_files(filenames, algorithm='md5', workers=None, index=None):
+    """
+    Hash many files in parallel with a thread pool, as hashlib releases the GIL for large blocks.
+    If a HashIndex is given, unchanged files are not hashed again and the index is saved.
+    """
+    if index is None:
+        hash_file = functools.partial(file_hash, algorithm=algorithm)
+    else:
+        hash_file = functools.partial(index.digest, algorithm=algorithm)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        digests = list(executor.map(hash_file, filenames))
+    if index is not None:
+        index.save()
+    return digests
+
+
+def cached_download(url, path, md5=None, quiet=False, hash_index=DEFAULT_HASH_INDEX):
     """
     Download url in path using md5.
+    Digests of existing files are looked up in the HashIndex stored at hash_index,
+    None disables the index.
 
     References:
         - https://github.com/wkentaro/fcn
     """
+    def get_md5(path):
+        if hash_index is None:
+            return md5sum(path)
+        index = get_hash_index(hash_index)
+        digest = index.digest(path)
+        index.save()
+        return digest
+
     def check_md5(path, md5):
         print('[{:s}] Checking md5 ({:s})'.format(path, md5))
-        return md5sum(path) == md5
+        return get_md5(path) == md5
 
     if os.path.exists(path) and not md5:
-        print('[{:s}] File exists ({:s})'.format(path, md5sum(path)))
+        print('[{:s}] File exists ({:s})'.format(path, get_md5(path)))
     elif os.path.exists(path) and md5 and check_md5(path, md5):
         pass
     else:
         dirpath = os.path.dirname(path)
         if not os.path.exists(dirpath):
             os.makedirs(dirpath)
+        import gdown
         gdown.download(url, path, quiet=quiet)
 
     return path
 
 def replace_line_in_file(pathname, pattern, subst):
     """Replace pattern in line with subst"""
-    # Create temp file
-    f_h, abs_path = mkstemp()
-    with os.fdopen(f_h, 'w') as new_file:
-        with open(pathname) as old_file:
-            for line in old_file:
-                if pattern in line:
-                    new_file.write(subst)
-                else:
+    replace_lines_in_file(pathname, [(pattern, subst)])
+
+def _contains_any(pathname, patterns, encoding):
+    """Scan memory-mapped file for any of the patterns without decoding it"""
+    encoding = encoding or locale.getpreferredencoding(False)
+    with open(pathname, 'rb') as f_handle:
+        if os.fstat(f_handle.fileno()).st_size == 0:
+            return False
+        with mmap.mmap(f_handle.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            return any(mapped.find(pattern.encode(encoding)) >= 0 for pattern in patterns)
+
+def replace_lines_in_file(pathname, substitutions, scan=True, encoding=None, buffer_size=2**20):
+    """
+    Replace each line containing a pattern with its subst in one streaming pass,
+    where the first matching pattern wins.
+    The result is written to a temp file next to the original,
+    which is then atomically replaced, so the file is never missing.
+
+    Args:
+        pathname: file to patch
+        substitutions: dict or sequence of (pattern, subst) pairs
+        scan: skip the rewrite if a scan of the memory-mapped file finds no pattern
+        encoding: text encoding, defaults to the platform encoding
+        buffer_size: size of read and write buffers
+    Returns:
+        True if the file has been rewritten
+    """
+    substitutions = list(dict(substitutions).items())
+    if scan and not _contains_any(pathname, [pattern for pattern, __ in substitutions], encoding):
+        return False
+    f_h, abs_path = mkstemp(dir=os.path.dirname(os.path.abspath(pathname)))
+    try:
+        with os.fdopen(f_h, 'w', buffering=buffer_size, encoding=encoding) as new_file:
+            with open(pathname, buffering=buffer_size, encoding=encoding) as old_file:
+                for line in old_file:
+                    for pattern, subst in substitutions:
+                        if pattern in line:
+                            line = subst
+                            break
                     new_file.write(line)
-    # Remove original file
-    os.remove(pathname)
-    # Move new file
-    move(abs_path, pathname)
+        shutil.copymode(pathname, abs_path)
+        os.replace(abs_path, pathname)
+    except BaseException:
+        os.remove(abs_path)
+        raise
+    return True
+
+def replace_lines_in_files(pathnames, substitutions, workers=None, **kwargs):
+    """Apply replace_lines_in_file to many files in parallel, returns list of rewritten flags"""
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(
+            functools.partial(replace_lines_in_file, substitutions=substitutions, **kwargs), pathnames
+        ))
 
 def scale_value(value, source_range, target_range):
     """Scale given value from source range to target range"""
@@ -77,16 +217,320 @@ def scale_value(value, source_range, target_range):
         * (target_range[1] - target_range[0]) + target_range[0]
     )
 
-def lazy_property(function):
-    """Decorating function as lazy loading property"""
-    attribute = '_cache_' + function.__name__
-
-    @property
-    @functools.wraps(function)
-    def decorator(self):
-        """The decorator function"""
-        if not hasattr(self, attribute):
-            setattr(self, attribute, function(self))
-        return getattr(self, attribute)
+class Scaler:
+    """
+    Affine map from source range to target range, like scale_value,
+    with slope and offset precomputed once, optionally per column (last axis).
+    Floating point arrays keep their dtype, pass out=values to scale in place.
+    Buffers given as out need a floating point dtype.
+    """
+    def __init__(self, source_range, target_range=(0.0, 1.0), clip=False):
+        """
+        Args:
+            source_range: (low, high), scalars or arrays of one value per column
+            target_range: (low, high), scalars or arrays of one value per column
+            clip: clip results to target range (and source range for the inverse)
+        """
+        source = np.asarray(source_range, dtype=float)
+        target = np.asarray(target_range, dtype=float)
+        self.slope = (target[1] - target[0]) / (source[1] - source[0])
+        self.offset = target[0] - source[0] * self.slope
+        self.clip = clip
+        self.target_bounds = np.minimum(target[0], target[1]), np.maximum(target[0], target[1])
+        self.source_bounds = np.minimum(source[0], source[1]), np.maximum(source[0], source[1])
+        self._params = {}
+
+    def _cast(self, dtype, inverse):
+        """Slope, offset and bounds in dtype, cached per dtype"""
+        key = (dtype, inverse)
+        if key not in self._params:
+            if inverse:
+                params = (1 / self.slope, -self.offset / self.slope) + self.source_bounds
+            else:
+                params = (self.slope, self.offset) + self.target_bounds
+            self._params[key] = tuple(np.asarray(param, dtype=dtype) for param in params)
+        return self._params[key]
+
+    def _apply(self, values, out, inverse):
+        values = np.asarray(values)
+        if out is not None:
+            if not np.issubdtype(out.dtype, np.floating):
+                raise TypeError(f"out must have a floating point dtype, not {out.dtype}")
+            dtype = out.dtype
+        elif np.issubdtype(values.dtype, np.floating):
+            dtype = values.dtype
+        else:
+            dtype = np.dtype(float)
+        slope, offset, low, high = self._cast(dtype, inverse)
+        if out is None:
+            out = np.empty(np.broadcast_shapes(values.shape, slope.shape), dtype=dtype)
+        np.multiply(values, slope, out=out)
+        np.add(out, offset, out=out)
+        if self.clip:
+            np.clip(out, low, high, out=out)
+        return out if out.ndim else out[()]
+
+    def transform(self, values, out=None):
+        """Scale values from source to target range"""
+        return self._apply(values, out, inverse=False)
+
+    __call__ = transform
+
+    def inverse(self, values, out=None):
+        """Scale values from target back to source range"""
+        return self._apply(values, out, inverse=True)
+
+_MISSING = object()
+
+class LazyProperty:
+    """
+    Property, which is computed once per instance under a per-instance lock
+    and cached in the attribute '_cache_' + name until it is deleted or invalidated.
+    The locks are kept in a table of the descriptor instead of on the instance,
+    so instances stay picklable and copies do not share them.
+    If it depends on other attributes, it is recomputed once any of them is
+    rebound to another object, which includes recomputed lazy properties.
+    """
+    def __init__(self, function, depends_on=()):
+        self.function = function
+        self.depends_on = tuple(depends_on)
+        self.attribute = '_cache_' + function.__name__
+        self.deps_attribute = self.attribute + '_deps'
+        # id(instance) -> [lock, number of threads using it], only while in use
+        self.locks = {}
+        self.locks_lock = threading.Lock()
+        functools.update_wrapper(self, function)
+
+    @contextlib.contextmanager
+    def _lock(self, instance):
+        """Hold the lock of instance, which is dropped from the table once unused"""
+        key = id(instance)
+        with self.locks_lock:
+            entry = self.locks.setdefault(key, [threading.RLock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self.locks_lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self.locks[key]
+
+    def _dependencies(self, instance):
+        return tuple(getattr(instance, name) for name in self.depends_on)
+
+    def _is_valid(self, instance):
+        if not self.depends_on:
+            return True
+        recorded = getattr(instance, self.deps_attribute, _MISSING)
+        return recorded is not _MISSING and all(
+            current is previous
+            for current, previous in zip(self._dependencies(instance), recorded)
+        )
+
+    def __get__(self, instance, owner=None):
+        if instance is None:
+            return self
+        value = getattr(instance, self.attribute, _MISSING)
+        if value is not _MISSING and self._is_valid(instance):
+            return value
+        with self._lock(instance):
+            value = getattr(instance, self.attribute, _MISSING)
+            if value is _MISSING or not self._is_valid(instance):
+                dependencies = self._dependencies(instance)
+                value = self.function(instance)
+                if self.depends_on:
+                    object.__setattr__(instance, self.deps_attribute, dependencies)
+                object.__setattr__(instance, self.attribute, value)
+        return value
+
+    def __set__(self, instance, value):
+        raise AttributeError(f"can't set lazy property '{self.__name__}'")
+
+    def __delete__(self, instance):
+        self.invalidate(instance)
+
+    def invalidate(self, instance):
+        """Drop cached value of instance"""
+        with self._lock(instance):
+            for attribute in (self.attribute, self.deps_attribute):
+                try:
+                    object.__delattr__(instance, attribute)
+                except AttributeError:
+                    pass
+
+def lazy_property(function=None, depends_on=()):
+    """
+    Decorating function as lazy loading property,
+    used as @lazy_property or @lazy_property(depends_on=('attribute', ...))
+    """
+    if function is None:
+        return functools.partial(lazy_property, depends_on=depends_on)
+    return LazyProperty(function, depends_on)
+
+def lazy_slots(*names):
+    """
+    Slots needed by lazy properties of a class with __slots__, e.g.
+    __slots__ = ('data',) + lazy_slots('mean', 'std')
+    """
+    return tuple(f'_cache_{name}{suffix}' for name in names for suffix in ('', '_deps'))
+
+def invalidate_lazy(instance, *names):
+    """Drop cached values of the named lazy properties of instance or of all if none are named"""
+    for cls in type(instance).__mro__:
+        for name, attribute in vars(cls).items():
+            if isinstance(attribute, LazyProperty) and (not names or name in names):
+                attribute.invalidate(instance)
+
+def _update_key(hsh, value):
+    """Feed an argument into the hash, arrays by dtype, shape and content"""
+    if isinstance(value, np.ndarray) and value.dtype.hasobject:
+        # References cannot be viewed as bytes, object arrays are hashed like stored results
+        hsh.update(b'ndarray:object:')
+        hsh.update(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+    elif isinstance(value, np.ndarray):
+        hsh.update(f'ndarray:{value.dtype.str}:{value.shape}:'.encode())
+        hsh.update(np.ascontiguousarray(value).view(np.uint8).data)
+    elif isinstance(value, (list, tuple)):
+        hsh.update(f'{type(value).__name__}:{len(value)}:'.encode())
+        for item in value:
+            _update_key(hsh, item)
+    elif isinstance(value, dict):
+        hsh.update(f'dict:{len(value)}:'.encode())
+        for key in sorted(value, key=repr):
+            _update_key(hsh, key)
+            _update_key(hsh, value[key])
+    else:
+        hsh.update(f'{type(value).__qualname__}:{value!r};'.encode())
+
+def evict_lru(directory, max_bytes):
+    """
+    Remove least recently used entries (files or directories) of a cache directory
+    until it fits into max_bytes, where the modification time of an entry marks its last access.
+    Hidden entries, e.g. staging files, are ignored.
+    """
+    if max_bytes is None:
+        return
+    entries = []
+    for entry in os.scandir(directory):
+        if entry.name.startswith('.'):
+            continue
+        if entry.is_dir():
+            size = sum(item.stat().st_size for item in os.scandir(entry.path))
+        else:
+            size = entry.stat().st_size
+        entries.append((entry.stat().st_mtime_ns, size, entry.path, entry.is_dir()))
+    total = sum(size for __, size, __, __ in entries)
+    for __, size, path, is_dir in sorted(entries):
+        if total <= max_bytes:
+            break
+        if is_dir:
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        total -= size
+
+def memoize_arrays(directory, max_bytes=None, mmap_mode=None):
+    """
+    Decorator caching results of an expensive function on disk,
+    keyed on the function name and the contents of its array arguments.
+    Array results are stored as .npy files, other results are pickled.
+    The decorated function provides cache_info() with hit rate and cache_clear().
+
+    Args:
+        directory: cache directory, which will be generated
+        max_bytes: maximum size of all entries, evicted in least recently used order,
+            unbounded if None
+        mmap_mode: memory-map loaded array results, see numpy.load
+    """
+    os.makedirs(directory, exist_ok=True)
+
+    def decorator(function):
+        stats = {'hits': 0, 'misses': 0}
+        lock = threading.Lock()
+
+        def key(args, kwargs):
+            hsh = hashlib.blake2b(digest_size=20)
+            hsh.update(f'{function.__module__}.{function.__qualname__}:'.encode())
+            _update_key(hsh, args)
+            _update_key(hsh, kwargs)
+            return hsh.hexdigest()
+
+        def load(entry):
+            for suffix in ('.npy', '.pkl'):
+                pathname = os.path.join(directory, entry + suffix)
+                try:
+                    if suffix == '.npy':
+                        value = np.load(pathname, mmap_mode=mmap_mode)
+                    else:
+                        with open(pathname, 'rb') as f_handle:
+                            value = pickle.load(f_handle)
+                    # Marks the last access for evict_lru
+                    os.utime(pathname)
+                except FileNotFoundError:
+                    # Entry has been evicted concurrently
+                    continue
+                return value
+            return _MISSING
+
+        def store(entry, value):
+            f_h, tmp_path = mkstemp(dir=directory, prefix='.staging-')
+            try:
+                with os.fdopen(f_h, 'wb') as f_handle:
+                    if isinstance(value, np.ndarray) and not value.dtype.hasobject:
+                        suffix = '.npy'
+                        np.save(f_handle, value, allow_pickle=False)
+                    else:
+                        suffix = '.pkl'
+                        pickle.dump(value, f_handle, protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(tmp_path, os.path.join(directory, entry + suffix))
+            except BaseException:
+                os.remove(tmp_path)
+                raise
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            entry = key(args, kwargs)
+            value = load(entry)
+            if value is not _MISSING:
+                with lock:
+                    stats['hits'] += 1
+                return value
+            with lock:
+                stats['misses'] += 1
+            value = function(*args, **kwargs)
+            store(entry, value)
+            evict_lru(directory, max_bytes)
+            return value
+
+        def cache_info():
+            """Hits, misses, hit rate and size in bytes of the cache"""
+            with lock:
+                hits, misses = stats['hits'], stats['misses']
+            return {
+                'hits': hits,
+                'misses': misses,
+                'hit_rate': hits / (hits + misses) if hits + misses else 0.0,
+                'bytes': sum(
+                    item.stat().st_size for item in os.scandir(directory)
+                    if item.is_file() and not item.name.startswith('.')
+                ),
+            }
+
+        def cache_clear():
+            """Remove all entries and reset statistics"""
+            for item in os.scandir(directory):
+                if item.is_file() and not item.name.startswith('.'):
+                    os.remove(item.path)
+            with lock:
+                stats.update(hits=0, misses=0)
+
+        wrapper.cache_info = cache_info
+        wrapper.cache_clear = cache_clear
+        return wrapper
 
     return decorator
@@ -1,31 +1,127 @@
 """Classes and methods for plotting convenience"""
 
 import math
+import time
 import numpy as np
 import matplotlib
 import matplotlib.pyplot as plt
 from matplotlib import colors
+from matplotlib.figure import Figure
+from matplotlib.collections import PolyCollection
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 from matplotlib.ticker import PercentFormatter
 import matplotlib.ticker as mticker
 
-def hist(data, filename, nb_bins='fd', xlabel='Data', fontsize=14, figsize=(7, 4), save=False):
-    """Plot histogram of data"""
-    __, axs = plt.subplots(1, 1, figsize=figsize)
-    bins, __, patches = axs.hist(data, bins=nb_bins)
-    # We'll color code by height, but you could use any scalar
-    fracs = bins / bins.max()
+def _bin_width(sample, size, ptp, estimator):
+    """
+    Bin width of numpy's bin estimators for size values spanning ptp,
+    whose further statistics are taken from a sample of them. None for 'stone'.
+    """
+    if estimator == 'sqrt':
+        return ptp / np.sqrt(size)
+    if estimator == 'sturges':
+        return ptp / (np.log2(size) + 1)
+    if estimator == 'rice':
+        return ptp / (2 * size**(1 / 3))
+    if estimator == 'scott':
+        return (24 * np.pi**0.5 / size)**(1 / 3) * np.std(sample)
+    if estimator == 'fd':
+        return 2 * np.subtract(*np.percentile(sample, [75, 25])) * size**(-1 / 3)
+    if estimator == 'doane':
+        sigma = np.std(sample)
+        if size <= 2 or sigma <= 0:
+            return 0.0
+        s_g1 = np.sqrt(6 * (size - 2) / ((size + 1) * (size + 3)))
+        g_1 = np.mean(((sample - np.mean(sample)) / sigma)**3)
+        return ptp / (1 + np.log2(size) + np.log2(1 + np.abs(g_1) / s_g1))
+    if estimator == 'auto':
+        fd_width = _bin_width(sample, size, ptp, 'fd')
+        sturges_width = _bin_width(sample, size, ptp, 'sturges')
+        return min(fd_width, sturges_width) if fd_width else sturges_width
+    return None
+
+def _hist_edges(data, bins, value_range, chunk_size, sample_size):
+    """
+    Bin count and range for np.histogram, computed chunk-wise for large arrays.
+    Estimators as 'fd' are evaluated on a strided sample of at most sample_size values
+    with their dependence on the number of values scaled to the full size,
+    except for 'stone', which is evaluated on the sample only.
+    """
+    if value_range is None:
+        value_range = (
+            min(data[idx:idx + chunk_size].min() for idx in range(0, len(data), chunk_size)),
+            max(data[idx:idx + chunk_size].max() for idx in range(0, len(data), chunk_size)),
+        )
+    if not isinstance(bins, str):
+        return bins, value_range
+    step = max(1, math.ceil(len(data) / sample_size))
+    sample = np.asarray(data[::step])
+    if step == 1:
+        return len(np.histogram_bin_edges(sample, bins, value_range)) - 1, value_range
+    # Like numpy, the estimators only consider values within the range
+    inside = (sample >= value_range[0]) & (sample <= value_range[1])
+    sample = sample[inside]
+    # The sample misses the extremes, hence the span is taken from the full range
+    width = _bin_width(
+        sample, len(data) * len(sample) / len(inside), value_range[1] - value_range[0], bins
+    )
+    if width is None:
+        return len(np.histogram_bin_edges(sample, bins, value_range)) - 1, value_range
+    if not width:
+        return 1, value_range
+    return math.ceil((value_range[1] - value_range[0]) / width), value_range
+
+def histogram_counts(data, bins='fd', value_range=None, chunk_size=2**22, sample_size=2**20):
+    """
+    Histogram of large data computed chunk-wise with np.histogram
+
+    Args:
+        data: array, e.g. memory-mapped, or iterable of array chunks
+        bins: number of bins, bin edges or estimator name as 'fd',
+            iterables of chunks need a value_range for number of bins or estimators
+        value_range: (min, max) of the bins, computed from arrays if None
+        chunk_size: number of values per chunk of arrays
+        sample_size: maximum number of values used for the bin estimator
+    Returns:
+        counts and bin edges
+    """
+    uniform = np.ndim(bins) == 0
+    if hasattr(data, '__len__'):
+        data = np.asarray(data).ravel()
+        if uniform:
+            bins, value_range = _hist_edges(data, bins, value_range, chunk_size, sample_size)
+        chunks = (data[idx:idx + chunk_size] for idx in range(0, len(data), chunk_size))
+    elif uniform and (value_range is None or isinstance(bins, str)):
+        raise ValueError("Iterables of chunks need bin edges or a number of bins and a value_range")
+    else:
+        chunks = data
+    edges = np.histogram_bin_edges([], bins, value_range)
+    counts = np.zeros(len(edges) - 1, dtype=np.int64)
+    for chunk in chunks:
+        # Number of bins and range keep np.histogram on its fast path for uniform bins
+        counts += np.histogram(
+            chunk, bins=len(edges) - 1 if uniform else edges, range=value_range if uniform else None
+        )[0]
+    return counts, edges
 
+def _plot_hist(axs, counts, edges, xlabel, fontsize):
+    """Draw histogram bars as one PolyCollection colored by height"""
+    # We'll color code by height, but you could use any scalar
+    fracs = counts / counts.max()
     # we need to normalize the data to 0..1 for the full range of the colormap
     norm = colors.Normalize(fracs.min(), fracs.max())
-
-    # Now, we'll loop through our objects and set the color of each accordingly
-    for thisfrac, thispatch in zip(fracs, patches):
-        cmap = matplotlib.cm.get_cmap("viridis")
-        color = cmap(norm(thisfrac))
-        thispatch.set_facecolor(color)
+    verts = np.empty((len(counts), 4, 2))
+    verts[:, [0, 1], 0] = edges[:-1, None]
+    verts[:, [2, 3], 0] = edges[1:, None]
+    verts[:, [0, 3], 1] = 0
+    verts[:, [1, 2], 1] = counts[:, None]
+    axs.add_collection(PolyCollection(
+        verts, facecolors=matplotlib.colormaps['viridis'](norm(fracs)), edgecolors='face'
+    ))
+    axs.autoscale_view()
     axs.set_xlabel(xlabel, fontsize=fontsize)
     axs.set_ylabel('Distribution', fontsize=fontsize)
-    axs.yaxis.set_major_formatter(PercentFormatter(xmax=np.sum(bins)))
+    axs.yaxis.set_major_formatter(PercentFormatter(xmax=np.sum(counts)))
     axs.spines.right.set_visible(False)
     axs.spines.top.set_visible(False)
 
@@ -36,6 +132,15 @@ def hist(data, filename, nb_bins='fd', xlabel='Data', fontsize=14, figsize=(7, 4
             # kld += p_x * math.log(p_x / (1 / len(bins)))
     # print("Kullback-Leibler divergence: {}".format(kld))
     axs.tick_params(axis='both', which='major', labelsize=fontsize-2)
+
+def hist(
+        data, filename, nb_bins='fd', xlabel='Data', fontsize=14, figsize=(7, 4), save=False,
+        value_range=None, chunk_size=2**22
+    ):
+    """Plot histogram of data (array, memory-mapped array or iterable of chunks, see histogram_counts)"""
+    counts, edges = histogram_counts(data, nb_bins, value_range, chunk_size)
+    __, axs = plt.subplots(1, 1, figsize=figsize)
+    _plot_hist(axs, counts, edges, xlabel, fontsize)
     if save:
         plt.savefig(filename, dpi=600, bbox_inches='tight')
     else:
@@ -45,6 +150,26 @@ def hist(data, filename, nb_bins='fd', xlabel='Data', fontsize=14, figsize=(7, 4
 
     # return kld
 
+def hist_batch(datasets, filenames, xlabels=None, dpi=600, figsize=(7, 4), fontsize=14, **kwargs):
+    """
+    Export histograms of many datasets without pyplot,
+    rendered one after another on a single reused Agg figure
+
+    Args:
+        datasets: sequence of data as accepted by histogram_counts
+        filenames: output filename per dataset
+        xlabels: x label per dataset, 'Data' if None
+        kwargs: arguments of histogram_counts, e.g. bins or value_range
+    """
+    fig = Figure(figsize=figsize)
+    FigureCanvasAgg(fig)
+    xlabels = xlabels or ['Data'] * len(filenames)
+    for data, filename, xlabel in zip(datasets, filenames, xlabels):
+        counts, edges = histogram_counts(data, **kwargs)
+        fig.clear()
+        _plot_hist(fig.subplots(1, 1), counts, edges, xlabel, fontsize)
+        fig.savefig(filename, dpi=dpi, bbox_inches='tight')
+
 def modify_axis(axs, xtick_label, ytick_label, xoffset, yoffset, fontsize, grid=True):
     """Change properties of plot axis to make more beautiful"""
     axs.spines['top'].set_visible(False)
@@ -91,14 +216,57 @@ def modify_axis(axs, xtick_label, ytick_label, xoffset, yoffset, fontsize, grid=
             label.set_fontsize(fontsize)
     return axs
 
+def minmax_decimate(values, nb_columns):
+    """
+    Reduce a long trace to the minimum and maximum of each of nb_columns pixel columns,
+    which renders identically to the full trace.
+
+    Returns:
+        x positions and values of the decimated trace
+    """
+    values = np.asarray(values)
+    if len(values) <= 2 * nb_columns:
+        return np.arange(len(values)), values
+    starts = np.linspace(0, len(values), nb_columns, endpoint=False).astype(np.intp)
+    x_pos = np.repeat(starts + (np.diff(starts, append=len(values)) - 1) / 2, 2)
+    y_pos = np.empty(2 * nb_columns, dtype=values.dtype)
+    y_pos[0::2] = np.minimum.reduceat(values, starts)
+    y_pos[1::2] = np.maximum.reduceat(values, starts)
+    return x_pos, y_pos
+
 class InteractivePlotter:
-    """Class for interactive plotting for optimization tasks"""
-    def __init__(self, rows, figsize, fontsize, colors):
+    """
+    Class for interactive plotting for optimization tasks.
+    Redraws can be throttled to max_fps or to every n-th update.
+    The blit mode caches the background and only redraws the lines, which are
+    decimated to min/max per pixel column. Its axes are only rescaled if the data
+    leaves their limits (padded by margin as hysteresis) or shrinks to less than half of them.
+    The headless mode draws on an Agg canvas without pyplot, e.g. for benchmarks.
+    """
+    def __init__(
+            self, rows, figsize, fontsize, colors, blit=False, headless=False,
+            max_fps=None, every=1, margin=0.1, decimate=True
+        ):
         self.plot_idx = 0
         self.fontsize = fontsize
         self.colors = colors
-        plt.ion()
-        self.fig, self.axs = plt.subplots(rows, 1, figsize=figsize, sharex=True)
+        self.blit = blit
+        self.headless = headless
+        self.min_interval = 1 / max_fps if max_fps else 0
+        self.every = every
+        self.margin = margin
+        self.decimate = decimate
+        self.nb_updates = 0
+        self.last_draw = -np.inf
+        self.pending = None
+        self.background = None
+        if headless:
+            self.fig = Figure(figsize=figsize)
+            FigureCanvasAgg(self.fig)
+            self.axs = self.fig.subplots(rows, 1, sharex=True)
+        else:
+            plt.ion()
+            self.fig, self.axs = plt.subplots(rows, 1, figsize=figsize, sharex=True)
 
         self.plots_pred = [None for __ in range(rows)]
         self.plots_target = [None for __ in range(rows)]
@@ -106,28 +274,107 @@ class InteractivePlotter:
     def init_plot(self, pred, target):
         """Initialize plot"""
         for idx, __ in enumerate(self.plots_target):
-            self.plots_target[idx] = self.axs[idx].plot(target[idx], color=self.colors[0])[0]
-            self.plots_pred[idx] = self.axs[idx].plot(pred[idx], color=self.colors[1])[0]
+            self.plots_target[idx] = self.axs[idx].plot(
+                target[idx], color=self.colors[0], animated=self.blit
+            )[0]
+            self.plots_pred[idx] = self.axs[idx].plot(
+                pred[idx], color=self.colors[1], animated=self.blit
+            )[0]
 
         self.axs[-1].set_xlabel('Samples', fontsize=self.fontsize, fontweight='bold')
 
-        plt.tight_layout()
+        if self.headless:
+            self.fig.tight_layout()
+        else:
+            plt.tight_layout()
+        if self.blit:
+            self.fig.canvas.mpl_connect('draw_event', self._on_draw)
+            self._set_data(pred, target)
+            self._rescale(force=True)
         self.fig.canvas.draw()
 
-    def update_plot(self, pred, target):
-        """Update data in axes"""
+    def _on_draw(self, event):
+        """Cache background after a full redraw, e.g. after rescaling or resizing"""
+        self.background = self.fig.canvas.copy_from_bbox(self.fig.bbox)
+        self._draw_lines()
+
+    def _draw_lines(self):
         for idx, __ in enumerate(self.plots_target):
-            self.plots_target[idx].set_ydata(target[idx])
-            self.plots_pred[idx].set_ydata(pred[idx])
-        for axis in self.axs:
-            axis.relim()
-            axis.autoscale_view()
-        # plt.pause(0.000000001)
-        self.fig.canvas.start_event_loop(0.000000001)
-        self.fig.canvas.draw()
+            self.axs[idx].draw_artist(self.plots_target[idx])
+            self.axs[idx].draw_artist(self.plots_pred[idx])
+
+    def _set_data(self, pred, target):
+        for idx, __ in enumerate(self.plots_target):
+            nb_columns = max(1, int(self.axs[idx].bbox.width))
+            for line, values in ((self.plots_target[idx], target[idx]), (self.plots_pred[idx], pred[idx])):
+                if self.decimate:
+                    line.set_data(*minmax_decimate(values, nb_columns))
+                else:
+                    line.set_data(np.arange(len(values)), values)
+
+    def _rescale(self, force=False):
+        """Rescale axes whose data left the limits, returns True if any limits changed"""
+        changed = False
+        for idx, axis in enumerate(self.axs):
+            lines = (self.plots_target[idx], self.plots_pred[idx])
+            x_max = max(line.get_xdata()[-1] for line in lines)
+            y_min = min(np.nanmin(line.get_ydata()) for line in lines)
+            y_max = max(np.nanmax(line.get_ydata()) for line in lines)
+            low, high = axis.get_ylim()
+            if force or y_min < low or y_max > high or (y_max - y_min) < 0.5 * (high - low):
+                pad = self.margin * (y_max - y_min) or 1
+                axis.set_ylim(y_min - pad, y_max + pad)
+                changed = True
+            if force or axis.get_xlim()[1] != x_max:
+                axis.set_xlim(0, x_max)
+                changed = True
+        return changed
+
+    def update_plot(self, pred, target, force=False):
+        """Update data in axes, skipped redraws are kept pending until the next one"""
+        self.nb_updates += 1
+        now = time.perf_counter()
+        if not force and (
+            self.nb_updates % self.every or now - self.last_draw < self.min_interval
+        ):
+            self.pending = (pred, target)
+            return
+        self.pending = None
+        self.last_draw = now
+        if not self.blit:
+            for idx, __ in enumerate(self.plots_target):
+                self.plots_target[idx].set_ydata(target[idx])
+                self.plots_pred[idx].set_ydata(pred[idx])
+            for axis in self.axs:
+                axis.relim()
+                axis.autoscale_view()
+            # plt.pause(0.000000001)
+            if not self.headless:
+                self.fig.canvas.start_event_loop(0.000000001)
+            self.fig.canvas.draw()
+            return
+        self._set_data(pred, target)
+        canvas = self.fig.canvas
+        if self._rescale() or self.background is None:
+            # Full redraw, the draw_event caches the new background
+            canvas.draw()
+        else:
+            canvas.restore_region(self.background)
+            self._draw_lines()
+            canvas.blit(self.fig.bbox)
+        if not self.headless:
+            canvas.flush_events()
+
+    def flush(self):
+        """Draw pending update skipped by throttling"""
+        if self.pending is not None:
+            self.update_plot(*self.pending, force=True)
 
     def show_plot(self):
         """Show plot at the end of the optimization task with ioff"""
+        self.flush()
+        if self.headless:
+            return
         plt.ioff()
         plt.show()
         plt.close()
@@ -1,124 +1,363 @@
 """Funtions for working with signals"""
 
+import os
 import math
+import heapq
+import functools
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
 import numpy as np
-import pandas as pd
+import scipy.ndimage
 import scipy.signal
-from numpy import matlib
 
 
 def find_elbow(series):
     """
     Method to find an elbow of a curve.
+    For 2-D input, one elbow is found per row.
     References:
         - https://stackoverflow.com/a/2022348
     """
-    coords = np.vstack((range(len(series)), series)).T
-
-    # Get the first point
-    first_point = coords[0]
-    # Get vector between first and last point - this is the line
-    line = coords[-1] - coords[0]
-    line_norm = line / np.sqrt(np.sum(line**2))
-
-    # Find the distance from each point to the line:
-    # Vector between all points and first point
-    from_first = coords - first_point
-
-    # To calculate the distance to the line, we split from_first into two
-    # components, one that is parallel to the line and one that is perpendicular.
-    # Then, we take the norm of the part that is perpendicular to the line and
-    # get the distance.
-    # We find the vector parallel to the line by projecting from_first onto
-    # the line. The perpendicular vector is from_first - from_first_parallel
-    # We project from_first by taking the scalar product of the vector with
-    # the unit vector that points in the direction of the line (this gives us
-    # the length of the projection of from_first onto the line). If we
-    # multiply the scalar product by the unit vector, we have from_first_parallel
-    prod = np.sum(from_first * np.matlib.repmat(line_norm, len(series), 1), axis=1)
-    from_first_parallel = np.outer(prod, line_norm)
-    to_line = from_first - from_first_parallel
-
-    # Distance to line is the norm of to_line
-    dist = np.sqrt(np.sum(to_line ** 2, axis=1))
+    series = np.asarray(series)
+    # First and last point in float, so differences of unsigned integers do not wrap around
+    first = series[..., :1].astype(float)
+    # Vector between first and last point (the line) with x-coordinates given by the index
+    d_x = series.shape[-1] - 1
+    d_y = series[..., -1:].astype(float) - first
+
+    # Distance of each point to the line is the norm of the cross product
+    # of the vector from the first point with the unit vector of the line,
+    # which is evaluated in place to avoid N x 2 temporaries
+    dist = np.arange(series.shape[-1], dtype=float) * -d_y
+    dist += d_x * (series - first)
+    np.abs(dist, out=dist)
+    dist /= np.sqrt(d_x**2 + d_y**2)
     # Knee/elbow is the point with max distance value
-    idx = np.argmax(dist)
+    idx = np.argmax(dist, axis=-1)
 
     return dist, idx
 
-def butter_lowpass(cutoff, freq, order=5):
-    """Butterworth lowpass filter"""
+def find_elbow_chunked(series, chunk_size=2**20):
+    """
+    Find elbow of a long curve like find_elbow, but evaluate the distances chunk by chunk,
+    e.g. for memory-mapped series, so the full distance array is never held in memory.
+    Returns:
+        maximum distance and its index
+    """
+    length = len(series)
+    first = float(series[0])
+    d_x = length - 1
+    d_y = float(series[length - 1]) - first
+    norm = math.sqrt(d_x**2 + d_y**2)
+    max_dist, max_idx = -np.inf, 0
+    for start in range(0, length, chunk_size):
+        chunk = np.asarray(series[start:start + chunk_size], dtype=float)
+        dist = np.arange(start, start + len(chunk), dtype=float) * -d_y
+        dist += d_x * (chunk - first)
+        np.abs(dist, out=dist)
+        idx = np.argmax(dist)
+        if dist[idx] / norm > max_dist:
+            max_dist, max_idx = dist[idx] / norm, start + int(idx)
+    return max_dist, max_idx
+
+@functools.lru_cache(maxsize=128)
+def _butter_design(order, normal_cutoff, output):
+    """Cached design of a digital Butterworth lowpass filter"""
+    design = scipy.signal.butter(order, normal_cutoff, btype='low', analog=False, output=output)
+    if output == 'sos':
+        return (design,)
+    return design
+
+def butter_cache_info():
+    """Hits, misses and size of the Butterworth design cache"""
+    return _butter_design.cache_info()
+
+def butter_lowpass(cutoff, freq, order=5, output='ba'):
+    """
+    Butterworth lowpass filter, either as (numerator, denominator) or second-order sections.
+    Designs are cached by order, normalized cutoff and output form,
+    copies are returned to keep the cache unaffected by modifications of the caller.
+    """
     nyq = 0.5 * freq
-    normal_cutoff = cutoff / nyq
-    numerator, denominator = scipy.signal.butter(order, normal_cutoff, btype='low', analog=False)
-    return numerator, denominator
+    normal_cutoff = float(cutoff / nyq)
+    if output == 'sos':
+        return _butter_design(int(order), normal_cutoff, 'sos')[0].copy()
+    numerator, denominator = _butter_design(int(order), normal_cutoff, 'ba')
+    return numerator.copy(), denominator.copy()
 
-def butter_lowpass_filter(sig, cutoff, freq, order=5):
-    """Apply filter to signal"""
+def butter_lowpass_filter(sig, cutoff, freq, order=5, axis=-1):
+    """Apply filter to signal, multi-channel signals are filtered at once along axis"""
     numerator, denominator = butter_lowpass(cutoff, freq, order=order)
-    return scipy.signal.lfilter(numerator, denominator, sig)
-
-def window_smoothing(sig_y, window_size, window_function):
-    """Smooth signal by averging using a specific window function"""
-    filtered_y = pd.DataFrame(sig_y).rolling(
-        window=window_size,
-        win_type=window_function,
-        center=True
-    ).mean().squeeze().fillna(0.0) # Smoooooth af
-    # First 'window_size' values of the filtered signal have to be discarded (are NaNs anyway).
+    return scipy.signal.lfilter(numerator, denominator, sig, axis=axis)
+
+class ButterLowpassFilter:
+    """
+    Stateful Butterworth lowpass filter for signals which are processed chunk by chunk.
+    The filter is designed once as second-order sections and the filter state
+    is carried between chunks along the last axis.
+    """
+    def __init__(self, cutoff, freq, order=5):
+        self.sos = butter_lowpass(cutoff, freq, order=order, output='sos')
+        self.zi = None
+
+    def reset(self):
+        """Reset filter state to zero initial conditions"""
+        self.zi = None
+
+    def filter(self, chunk):
+        """Filter next chunk, consecutive outputs equal a one-shot call of butter_lowpass_filter"""
+        chunk = np.asarray(chunk)
+        if self.zi is None:
+            self.zi = np.zeros((len(self.sos),) + chunk.shape[:-1] + (2,))
+        filtered, self.zi = scipy.signal.sosfilt(self.sos, chunk, zi=self.zi)
+        return filtered
+
+    def filter_chunks(self, chunks):
+        """Generator which filters an iterable of chunks"""
+        for chunk in chunks:
+            yield self.filter(chunk)
+
+    def impulse_length(self, tol=1e-12, max_length=2**24):
+        """Number of samples after which the impulse response decayed below tol relative to its peak"""
+        length = 256
+        while True:
+            impulse = np.zeros(length)
+            impulse[0] = 1.0
+            response = np.abs(scipy.signal.sosfilt(self.sos, impulse))
+            above = np.flatnonzero(response > tol * response.max())
+            if above[-1] < length // 2 or length >= max_length:
+                return int(above[-1]) + 1
+            length *= 2
+
+    def filtfilt_chunks(self, chunks, overlap=None):
+        """
+        Generator for zero-phase filtering of an iterable of chunks.
+        Each block is filtered forward and backward together with overlap samples of
+        context on both sides, so the padding transients decay before the emitted part.
+        The signal ends are padded like scipy.signal.sosfiltfilt.
+
+        Args:
+            chunks: iterable of arrays, filtered along the last axis
+            overlap: number of context samples, defaults to the impulse response length,
+                at least the padding length of sosfiltfilt
+        """
+        if overlap is None:
+            overlap = self.impulse_length()
+        # Shorter blocks than the padding would be rejected by sosfiltfilt
+        sections = self.sos.shape[0]
+        padlen = 3 * (2 * sections + 1 - min(
+            np.sum(self.sos[:, 2] == 0), np.sum(self.sos[:, 5] == 0)
+        ))
+        overlap = max(overlap, int(padlen))
+        history = None
+        pending = None
+        for chunk in chunks:
+            chunk = np.asarray(chunk)
+            pending = chunk if pending is None else np.concatenate((pending, chunk), axis=-1)
+            emit = pending.shape[-1] - overlap
+            if emit <= 0:
+                continue
+            block = pending if history is None else np.concatenate((history, pending), axis=-1)
+            start = 0 if history is None else history.shape[-1]
+            filtered = scipy.signal.sosfiltfilt(self.sos, block)
+            yield filtered[..., start:start + emit]
+            history = block[..., max(0, start + emit - overlap):start + emit]
+            pending = pending[..., emit:]
+        if pending is not None and pending.shape[-1] > 0:
+            block = pending if history is None else np.concatenate((history, pending), axis=-1)
+            start = 0 if history is None else history.shape[-1]
+            yield scipy.signal.sosfiltfilt(self.sos, block)[..., start:]
+
+@functools.lru_cache(maxsize=64)
+def smoothing_window(window_function, window_size):
+    """Cached symmetric window weights as used by pandas rolling with win_type"""
+    weights = scipy.signal.get_window(window_function, window_size, fftbins=False).astype(float)
+    weights.setflags(write=False)
+    return weights
+
+def _window_average(sig_y, weights, axis, direct_max=64):
+    """
+    Weighted average over all complete windows along axis ('valid' mode).
+    Small windows are correlated directly, large windows via FFT overlap-add.
+    Windows containing NaN result in NaN.
+    """
+    nans = np.isnan(sig_y)
+    has_nans = nans.any()
+    if has_nans:
+        sig_y = np.where(nans, 0.0, sig_y)
+    size = len(weights)
+    length = sig_y.shape[axis] - size + 1
+    if length <= 0:
+        shape = list(sig_y.shape)
+        shape[axis] = 0
+        return np.zeros(shape)
+    if size <= direct_max:
+        averaged = scipy.ndimage.correlate1d(
+            sig_y, weights / weights.sum(), axis=axis, mode='constant', origin=-(size // 2)
+        )
+        averaged = np.take(averaged, np.arange(length), axis=axis)
+    else:
+        kernel_shape = [1] * sig_y.ndim
+        kernel_shape[axis] = size
+        kernel = (weights[::-1] / weights.sum()).reshape(kernel_shape)
+        averaged = scipy.signal.oaconvolve(sig_y, kernel, mode='valid', axes=axis)
+    if has_nans:
+        # Count NaNs per window by the difference of cumulative sums
+        counts = np.cumsum(nans, axis=axis)
+        counts = np.concatenate((np.zeros_like(np.take(counts, [0], axis=axis)), counts), axis=axis)
+        counts = np.take(counts, np.arange(size, size + length), axis=axis) - np.take(
+            counts, np.arange(length), axis=axis
+        )
+        averaged[counts > 0] = np.nan
+    return averaged
+
+def window_smoothing(sig_y, window_size, window_function, axis=0):
+    """
+    Smooth signal by averging using a specific window function
+    Same as pandas rolling mean with win_type and center=True, where incomplete windows
+    at the signal ends and windows containing NaN result in 0.
+    """
+    sig_y = np.asarray(sig_y, dtype=float)
+    weights = smoothing_window(window_function, window_size)
+    averaged = _window_average(sig_y, weights, axis)
+    filtered_y = np.zeros_like(sig_y)
+    index = [slice(None)] * sig_y.ndim
+    index[axis] = slice(window_size // 2, window_size // 2 + averaged.shape[axis])
+    filtered_y[tuple(index)] = np.nan_to_num(averaged, nan=0.0) # Smoooooth af
+    # First 'window_size' values of the filtered signal have to be discarded (are zeros anyway).
     # Smmothed values corredpond to the center position within the windows.
     # Therefore, to align the filtered and un-filtered signals,
     # the indexing sequence ('sig_x' in this case)
     # has to be sliced by half of 'window_size' at the beginning and end.
     # sliced_x = sig_x[window_size // 2:-window_size // 2]
-    return filtered_y.values
+    return filtered_y
 
-def dtw(series1, series2, dist_fn, win=None):
+def window_smoothing_chunks(chunks, window_size, window_function, axis=0):
     """
-    Calculate dynamic time warping cost matrix
-    References:
-        - Omer Gold and Micha Sharir.
-          Dynamic Time Warping and Geometric Edit Distance: Breaking the Quadratic Barrier.
-          ACM Trans. Algorithms 14, 4, Article 50. (2018). DOI:https://doi.org/10.1145/3230734
-        - https://github.com/pierre-rouanet/dtw
+    Generator version of window_smoothing for an iterable of chunks along axis.
+    The concatenated output equals window_smoothing of the concatenated chunks.
+    """
+    weights = smoothing_window(window_function, window_size)
+    tail = None
+    seen = emitted = 0
+    for chunk in chunks:
+        chunk = np.asarray(chunk, dtype=float)
+        if tail is None:
+            tail = np.take(chunk, np.arange(0), axis=axis)
+        buffer = np.concatenate((tail, chunk), axis=axis)
+        averaged = np.nan_to_num(_window_average(buffer, weights, axis), nan=0.0)
+        seen += chunk.shape[axis]
+        # Leading zeros for incomplete windows at the signal start
+        leading = max(0, min(window_size // 2, seen) - emitted)
+        if leading:
+            shape = list(averaged.shape)
+            shape[axis] = leading
+            averaged = np.concatenate((np.zeros(shape), averaged), axis=axis)
+        emitted += averaged.shape[axis]
+        yield averaged
+        keep = min(window_size - 1, buffer.shape[axis])
+        tail = np.take(buffer, np.arange(buffer.shape[axis] - keep, buffer.shape[axis]), axis=axis)
+    if seen > emitted:
+        # Trailing zeros for incomplete windows at the signal end
+        shape = list(tail.shape)
+        shape[axis] = seen - emitted
+        yield np.zeros(shape)
+
+def _dtw_window(win, len1, len2):
+    """Return (below, above) diagonal extent of the Sakoe-Chiba band"""
+    if win is None:
+        return len1 - 1, len2 - 1
+    return min(win[0], len1 - 1), min(win[1], len2 - 1)
+
+def _dtw_rows(diag, len1, len2, below, above):
+    """Range of row indices of anti-diagonal diag which lie inside the band"""
+    low = max(0, diag - len2 + 1, -((above - diag) // 2))
+    high = min(len1 - 1, diag, (diag + below) // 2)
+    return low, high
+
+def _dtw_cost_fn(series1, series2, dist_fn):
     """
-    # Calculate costs
-    if win is not None:
-        dist = np.full((len(series1) + 1, len(series2) + 1), np.inf)
-        for idx in range(1, len(series1) + 1):
-            dist[idx, max(1, idx - win[0]):min(len(series1) + 1, idx + win[1] + 1)] = 0
-        dist[0, 0] = 0
+    Return function which evaluates the local costs of a block of cells
+    with row indices low..high on anti-diagonal diag.
+    dist_fn is called on the whole block of differences once
+    and only falls back to per-element calls if it is not vectorizable.
+    """
+    vectorized = [True]
+
+    def costs(low, high, diag):
+        diff = series1[low:high + 1] - series2[diag - high:diag - low + 1][::-1]
+        if vectorized[0]:
+            try:
+                cost = np.asarray(dist_fn(diff), dtype=float)
+                if cost.shape == (high - low + 1,):
+                    return cost
+            except (TypeError, ValueError):
+                pass
+            vectorized[0] = False
+        return np.fromiter((dist_fn(value) for value in diff), dtype=float, count=len(diff))
+
+    return costs
+
+def _dtw_accumulate(series1, series2, dist_fn, win=None):
+    """
+    Fill accumulated cost matrix along anti-diagonals.
+    Without window, the padded (n + 1) x (m + 1) matrix is allocated.
+    With window, only the padded band of shape (n + 1) x (win[0] + win[1] + 3) is allocated,
+    where cell (i, j) is stored at [i + 1, j - i + win[0] + 1].
+
+    Returns:
+        Padded storage and the (stride, offset) of the linear mapping
+        of cell (i, j) to the flat index stride * i + j + offset.
+    """
+    len1, len2 = len(series1), len(series2)
+    below, above = _dtw_window(win, len1, len2)
+    if win is None:
+        storage = np.full((len1 + 1, len2 + 1), np.inf)
+        storage[0, 0] = 0
+        stride, offset = len2 + 1, len2 + 2
     else:
-        dist = np.zeros((len(series1) + 1, len(series2) + 1))
-        dist[0, 1:] = np.inf
-        dist[1:, 0] = np.inf
-
-    acc_dist = dist[1:, 1:]
-
-    for idx, __ in enumerate(series1):
-        for jdx, __ in enumerate(series2):
-            if win is None or (max(0, idx - win[0]) <= jdx <= min(len(series2), idx + win[1])):
-                acc_dist[idx, jdx] = dist_fn(series1[idx] - series2[jdx])
-
-    # Calculate accumulated costs
-    jrange = range(len(series2))
-    for idx, __ in enumerate(series1):
-        if win is not None:
-            jrange = range(max(0, idx - win[0]), min(len(series2), idx + win[1] + 1))
-        for jdx in jrange:
-            acc_dist[idx, jdx] += min(
-                [
-                    dist[min(idx + 1, len(series1)), jdx],
-                    dist[idx, min(jdx + 1, len(series2))],
-                    dist[idx, jdx]
-                ]
-            )
+        width = below + above + 3
+        storage = np.full((len1 + 1, width), np.inf)
+        storage[0, below + 1] = 0
+        stride, offset = width - 1, width + below + 1
+    flat = storage.reshape(-1)
+    costs = _dtw_cost_fn(series1, series2, dist_fn)
+    step = stride - 1
+    for diag in range(len1 + len2 - 1):
+        low, high = _dtw_rows(diag, len1, len2, below, above)
+        if low > high:
+            continue
+        first = stride * low + diag - low + offset
+        last = first + step * (high - low) + 1
+        flat[first:last:step] = costs(low, high, diag) + np.minimum(
+            np.minimum(
+                flat[first - stride - 1:last - stride - 1:step],
+                flat[first - stride:last - stride:step]
+            ),
+            flat[first - 1:last - 1:step]
+        )
+    return storage, stride, offset
+
+def _dtw_traceback(storage, stride, offset, len1, len2, band=None):
+    """Trace optimal warping path back from the last cell of the accumulated costs"""
+    flat = storage.reshape(-1)
 
-    # Traceback
-    idx, jdx = np.array(np.shape(dist)) - 2
+    def value(idx, jdx):
+        """Accumulated cost of cell (idx, jdx) with padding row and column at -1"""
+        if band is not None and not -1 <= jdx - idx + band[0] <= band[0] + band[1] + 1:
+            return np.inf
+        return flat[stride * idx + jdx + offset]
+
+    idx, jdx = len1 - 1, len2 - 1
     path_x, path_y = [idx], [jdx]
     while (idx > 0) or (jdx > 0):
-        t_b = np.argmin((dist[idx, jdx], dist[idx, jdx + 1], dist[idx + 1, jdx]))
+        if idx == 0:
+            # Guard against leaving the matrix if the end cell is unreachable within the band
+            t_b = 2
+        elif jdx == 0:
+            t_b = 1
+        else:
+            t_b = np.argmin((value(idx - 1, jdx - 1), value(idx - 1, jdx), value(idx, jdx - 1)))
         if t_b == 0:
             idx -= 1
             jdx -= 1
@@ -126,8 +365,282 @@ def dtw(series1, series2, dist_fn, win=None):
             idx -= 1
         else:
             jdx -= 1
-        path_x.insert(0, idx)
-        path_y.insert(0, jdx)
+        path_x.append(idx)
+        path_y.append(jdx)
+    path_x.reverse()
+    path_y.reverse()
+    return [path_x, path_y]
 
-    return acc_dist, [path_x, path_y]
+def dtw(series1, series2, dist_fn, win=None, banded=False):
+    """
+    Calculate dynamic time warping cost matrix
+    Local costs are evaluated in bulk along anti-diagonals,
+    hence dist_fn should preferably accept numpy arrays (e.g. np.abs or np.square).
+    References:
+        - Omer Gold and Micha Sharir.
+          Dynamic Time Warping and Geometric Edit Distance: Breaking the Quadratic Barrier.
+          ACM Trans. Algorithms 14, 4, Article 50. (2018). DOI:https://doi.org/10.1145/3230734
+        - https://github.com/pierre-rouanet/dtw
+
+    Args:
+        series1: first series of length n
+        series2: second series of length m
+        dist_fn: local distance function applied to series1[i] - series2[j]
+        win: Sakoe-Chiba band as (below, above) extent around the diagonal
+        banded: if True and win is given, return the accumulated costs in band layout
+            of shape (n, below + above + 1) with the window clipped to the series lengths,
+            where column k of row i holds cell (i, i - below + k)
+    Returns:
+        accumulated cost matrix and warping path as [path_x, path_y]
+    """
+    series1, series2 = np.asarray(series1), np.asarray(series2)
+    len1, len2 = len(series1), len(series2)
+    storage, stride, offset = _dtw_accumulate(series1, series2, dist_fn, win)
+    if win is None:
+        return storage[1:, 1:], _dtw_traceback(storage, stride, offset, len1, len2)
+
+    band = _dtw_window(win, len1, len2)
+    path = _dtw_traceback(storage, stride, offset, len1, len2, band)
+    if banded:
+        return storage[1:, 1:-1], path
+    acc_dist = np.full((len1, len2), np.inf)
+    for idx in range(len1):
+        low, high = max(0, idx - band[0]), min(len2, idx + band[1] + 1)
+        if low >= high:
+            # Row lies entirely outside of the band
+            continue
+        acc_dist[idx, low:high] = storage[idx + 1, low - idx + band[0] + 1:high - idx + band[0] + 1]
+    return acc_dist, path
+
+def dtw_distance(series1, series2, dist_fn, win=None, max_dist=np.inf):
+    """
+    Calculate dynamic time warping distance without cost matrix and warping path.
+    Only three anti-diagonals of length min(n, m) + 1 are kept in memory.
+    Since every warping path crosses one of two consecutive anti-diagonals,
+    the accumulation is abandoned and inf is returned as soon as both exceed max_dist.
+    This requires a non-negative dist_fn.
+    """
+    series1, series2 = np.asarray(series1), np.asarray(series2)
+    if len(series1) > len(series2):
+        # Keep the shorter series along the buffers and mirror the differences
+        def mirrored_fn(diff, dist_fn=dist_fn):
+            return dist_fn(-diff)
+        series1, series2, dist_fn = series2, series1, mirrored_fn
+        win = None if win is None else (win[1], win[0])
+    len1, len2 = len(series1), len(series2)
+    below, above = _dtw_window(win, len1, len2)
+    costs = _dtw_cost_fn(series1, series2, dist_fn)
+
+    # Buffers hold anti-diagonals d - 2, d - 1 and d, cell (i, d - i) is stored at [i + 1]
+    buffers = [np.full(len1 + 1, np.inf) for __ in range(3)]
+    buffers[0][0] = 0
+    filled = [(0, 1), (0, 0), (0, 0)]
+    prev_min = 0
+    for diag in range(len1 + len2 - 1):
+        prev2, prev1, cur = buffers
+        cur[filled[2][0]:filled[2][1]] = np.inf
+        low, high = _dtw_rows(diag, len1, len2, below, above)
+        if low <= high:
+            cur[low + 1:high + 2] = costs(low, high, diag) + np.minimum(
+                np.minimum(prev2[low:high + 1], prev1[low:high + 1]),
+                prev1[low + 1:high + 2]
+            )
+            filled[2] = (low + 1, high + 2)
+        else:
+            filled[2] = (0, 0)
+        if max_dist < np.inf:
+            cur_min = cur[low + 1:high + 2].min() if low <= high else np.inf
+            if min(prev_min, cur_min) >= max_dist:
+                return np.inf
+            prev_min = cur_min
+        buffers = [prev1, cur, prev2]
+        filled = [filled[1], filled[2], filled[0]]
+    return float(buffers[1][len1])
+
+def dtw_envelope(series, length, win=None):
+    """
+    Lower and upper LB_Keogh envelope of series for queries of given length.
+    Position i of the envelope covers series[i - win[0]:i + win[1] + 1].
+    """
+    series = np.asarray(series, dtype=float)
+    below, above = _dtw_window(win, length, len(series))
+    size = below + above + 1
+    padded = np.pad(series, (below, max(0, length + above - len(series))), mode='edge')
+    center = size // 2
+    lower = scipy.ndimage.minimum_filter1d(padded, size)[center:center + length]
+    upper = scipy.ndimage.maximum_filter1d(padded, size)[center:center + length]
+    return lower, upper
+
+class DTWReferences:
+    """Library of reference series with LB_Keogh envelopes cached per query length"""
+    def __init__(self, references, win=None):
+        self.references = [np.asarray(ref, dtype=float) for ref in references]
+        self.win = win
+        self.envelopes = {}
+
+    def __len__(self):
+        return len(self.references)
+
+    def get_envelopes(self, length):
+        """Return envelopes of all references, build them on first request"""
+        if length not in self.envelopes:
+            self.envelopes[length] = [
+                dtw_envelope(ref, length, self.win) for ref in self.references
+            ]
+        return self.envelopes[length]
+
+def lb_kim(query, reference, dist_fn):
+    """Lower bound of dtw distance by the first and last cell, which lie on every path"""
+    bound = dist_fn(query[0] - reference[0])
+    if len(query) > 1 or len(reference) > 1:
+        bound += dist_fn(query[-1] - reference[-1])
+    return bound
 
+def lb_keogh(query, envelope, dist_fn):
+    """Lower bound of dtw distance by the distance of query to the reference envelope"""
+    lower, upper = envelope
+    return np.sum(dist_fn(query - np.clip(query, lower, upper)))
+
+def dtw_search(query, references, k=1, win=None, dist_fn=np.square):
+    """
+    Find the k nearest references of query in terms of dtw distance.
+    Candidates are discarded by the cascading lower bounds LB_Kim and LB_Keogh
+    and the accumulation is abandoned as soon as it exceeds the current k-th best distance.
+    References:
+        - Thanawin Rakthanmanon et al.
+          Searching and Mining Trillions of Time Series Subsequences under Dynamic Time Warping.
+          KDD 2012. DOI:https://doi.org/10.1145/2339530.2339576
+
+    Args:
+        query: one-dimensional series
+        references: sequence of reference series or DTWReferences,
+            which should be reused across queries to build the envelopes only once
+        k: number of nearest neighbours
+        win: Sakoe-Chiba band, ignored if references is a DTWReferences
+        dist_fn: vectorized, non-negative local distance with dist_fn(0) == 0,
+            which is monotonic in the absolute difference
+    Returns:
+        indices and distances of the nearest references in ascending order
+        and dict with the number of candidates pruned by each stage
+    """
+    if not isinstance(references, DTWReferences):
+        references = DTWReferences(references, win)
+    query = np.asarray(query, dtype=float)
+    envelopes = references.get_envelopes(len(query))
+    pruned = {'lb_kim': 0, 'lb_keogh': 0, 'abandoned': 0}
+
+    # Visit candidates in order of their cheapest bound to tighten the best-so-far early
+    bounds = np.array([lb_kim(query, ref, dist_fn) for ref in references.references])
+    best = []  # Max-heap of (-distance, index)
+    for position, index in enumerate(np.argsort(bounds, kind='stable')):
+        best_so_far = -best[0][0] if len(best) == k else np.inf
+        if bounds[index] >= best_so_far:
+            pruned['lb_kim'] += len(bounds) - position
+            break
+        if lb_keogh(query, envelopes[index], dist_fn) >= best_so_far:
+            pruned['lb_keogh'] += 1
+            continue
+        distance = dtw_distance(
+            query, references.references[index], dist_fn, references.win, best_so_far
+        )
+        if distance >= best_so_far:
+            pruned['abandoned'] += 1
+            continue
+        if len(best) == k:
+            heapq.heapreplace(best, (-distance, index))
+        else:
+            heapq.heappush(best, (-distance, index))
+    best = sorted((-neg_distance, index) for neg_distance, index in best)
+    indices = np.array([index for __, index in best], dtype=int)
+    distances = np.array([distance for distance, __ in best])
+    return indices, distances, pruned
+
+_POOL_STATE = {}
+
+def _dtw_pool_init(shm_name, layout, dist_fn, win, full):
+    """Attach worker process to the shared series buffer"""
+    shm = shared_memory.SharedMemory(name=shm_name)
+    _POOL_STATE['shm'] = shm
+    _POOL_STATE['series'] = [
+        np.ndarray(shape, dtype=np.float64, buffer=shm.buf, offset=offset)
+        for offset, shape in layout
+    ]
+    _POOL_STATE['args'] = (dist_fn, win, full)
+
+def _dtw_pair(series1, series2, dist_fn, win, full):
+    """Calculate dtw of one pair, either full or distance only"""
+    if full:
+        return dtw(series1, series2, dist_fn, win)
+    return dtw_distance(series1, series2, dist_fn, win)
+
+def _dtw_pool_task(index_pair):
+    """Calculate dtw of one pair of shared series"""
+    series1, series2 = (_POOL_STATE['series'][idx] for idx in index_pair)
+    return _dtw_pair(series1, series2, *_POOL_STATE['args'])
+
+def _dtw_pool(series_list, index_pairs, dist_fn, win, full, workers, chunksize):
+    """
+    Calculate dtw for index pairs into series_list with a process pool.
+    The series are copied once into shared memory, tasks only carry the index pairs.
+    """
+    series_list = [np.ascontiguousarray(ser, dtype=np.float64) for ser in series_list]
+    if workers == 1 or len(index_pairs) <= 1:
+        return [
+            _dtw_pair(series_list[idx], series_list[jdx], dist_fn, win, full)
+            for idx, jdx in index_pairs
+        ]
+
+    layout = []
+    nbytes = 0
+    for ser in series_list:
+        layout.append((nbytes, ser.shape))
+        nbytes += ser.nbytes
+    shm = shared_memory.SharedMemory(create=True, size=max(nbytes, 1))
+    try:
+        for (offset, shape), ser in zip(layout, series_list):
+            np.ndarray(shape, dtype=np.float64, buffer=shm.buf, offset=offset)[...] = ser
+        workers = workers or os.cpu_count()
+        if chunksize is None:
+            chunksize = max(1, len(index_pairs) // (4 * workers))
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=_dtw_pool_init,
+            initargs=(shm.name, layout, dist_fn, win, full)
+        ) as executor:
+            return list(executor.map(_dtw_pool_task, index_pairs, chunksize=chunksize))
+    finally:
+        shm.close()
+        shm.unlink()
+
+def dtw_batch(pairs, dist_fn, win=None, full=False, workers=None, chunksize=None):
+    """
+    Calculate dtw for many independent pairs of series in parallel.
+
+    Args:
+        pairs: sequence of (series1, series2) tuples
+        dist_fn: local distance function, has to be picklable (no lambda)
+        win: Sakoe-Chiba band
+        full: if True, return (acc_dist, path) of dtw for each pair instead of the distance
+        workers: number of processes, defaults to the number of CPUs, 1 runs in-process
+        chunksize: number of pairs per task
+    Returns:
+        list of results in order of pairs
+    """
+    series_list = [ser for pair in pairs for ser in pair]
+    index_pairs = [(2 * idx, 2 * idx + 1) for idx in range(len(pairs))]
+    return _dtw_pool(series_list, index_pairs, dist_fn, win, full, workers, chunksize)
+
+def dtw_matrix(series_list, dist_fn, win=None, workers=None, chunksize=None):
+    """
+    Calculate N x N matrix of pairwise dtw distances in parallel.
+    Only the upper triangle is computed, hence dist_fn has to be symmetric
+    with dist_fn(0) == 0 and win symmetric, if given.
+    """
+    nb_series = len(series_list)
+    rows, cols = np.triu_indices(nb_series, k=1)
+    index_pairs = list(zip(rows.tolist(), cols.tolist()))
+    distances = _dtw_pool(series_list, index_pairs, dist_fn, win, False, workers, chunksize)
+    matrix = np.zeros((nb_series, nb_series))
+    matrix[rows, cols] = distances
+    matrix[cols, rows] = distances
+    return matrix
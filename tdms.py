@@ -1,10 +1,19 @@
 """Operations on TDMS files"""
 
+import os
+import json
+import shutil
+import hashlib
+import functools
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 import numpy as np
 from nptdms import TdmsFile, TdmsWriter, ChannelObject
 
+from . import misc
 
-def read_tdms(pathname, keys, groupname):
+
+def read_tdms(pathname, keys, groupname, start=None, stop=None, lazy=False, memmap_dir=None):
     """
     Read data from TDMS file
 
@@ -12,13 +21,171 @@ def read_tdms(pathname, keys, groupname):
         pathname: name of the tdms file, which will be read
         keys: list of channel names for each column
         groupname: name of group, under which the channels are placed
+        start: first sample, which will be read for each channel
+        stop: sample before which reading stops for each channel
+        lazy: only read the requested channels (samples) instead of the whole file,
+            implied by start, stop and memmap_dir
+        memmap_dir: directory in which channel data is stored as memory-mapped arrays
+            instead of being held in memory
     Returns:
         numpy array containing a column for each channel
     """
-    tdms_file = TdmsFile.read(pathname)
-    return [tdms_file[groupname][key].data for key in keys]
+    if not lazy and start is None and stop is None and memmap_dir is None:
+        tdms_file = TdmsFile.read(pathname)
+        return [tdms_file[groupname][key].data for key in keys]
+    with TdmsFile.open(pathname, memmap_dir=memmap_dir) as tdms_file:
+        group = tdms_file[groupname]
+        return [group[key][start:stop] for key in keys]
+
+class TdmsCache:
+    """
+    On-disk cache of channels extracted from TDMS files.
+    Each entry is a directory of .npy files, which are loaded as memory-mapped arrays.
+    Entries are keyed by file path, modification time and size (or the md5 sum of the file),
+    group and channel names and are evicted in least recently used order.
+    """
+    def __init__(
+            self, directory, max_bytes=None, content_hash=False,
+            hash_index=misc.DEFAULT_HASH_INDEX
+        ):
+        """
+        Args:
+            directory: cache directory, which will be generated
+            max_bytes: maximum size of all entries, unbounded if None
+            content_hash: key files by md5 sum instead of modification time and size,
+                the sums are kept in the misc.HashIndex stored at hash_index, so a file
+                is only hashed again once its modification time or size changed
+            hash_index: path of the index file, which is saved by index_files
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.content_hash = content_hash
+        self.hash_index = hash_index
+        os.makedirs(directory, exist_ok=True)
+
+    def index_files(self, pathnames, workers=None):
+        """Hash files for content keys in parallel and save the index once"""
+        if self.content_hash:
+            misc.hash_files(pathnames, workers=workers, index=misc.get_hash_index(self.hash_index))
+
+    def key(self, pathname, keys, groupname):
+        """Cache key of the channels of a TDMS file"""
+        pathname = os.path.realpath(pathname)
+        if self.content_hash:
+            version = misc.get_hash_index(self.hash_index).digest(pathname)
+        else:
+            stat = os.stat(pathname)
+            version = [stat.st_mtime_ns, stat.st_size]
+        description = json.dumps([pathname, version, groupname, list(keys)])
+        return hashlib.md5(description.encode()).hexdigest()
+
+    def load(self, pathname, keys, groupname):
+        """Return cached channels as memory-mapped arrays or None"""
+        entry = os.path.join(self.directory, self.key(pathname, keys, groupname))
+        try:
+            data = [
+                np.load(os.path.join(entry, f'{idx}.npy'), mmap_mode='r')
+                for idx in range(len(keys))
+            ]
+            # Marks the last access for misc.evict_lru
+            os.utime(entry)
+        except FileNotFoundError:
+            return None
+        return data
+
+    def store(self, pathname, keys, groupname, data):
+        """Store channels, the entry only becomes visible once it is complete"""
+        entry = os.path.join(self.directory, self.key(pathname, keys, groupname))
+        staging = tempfile.mkdtemp(dir=self.directory, prefix='.staging-')
+        for idx, values in enumerate(data):
+            np.save(os.path.join(staging, f'{idx}.npy'), values)
+        try:
+            os.replace(staging, entry)
+        except OSError:
+            # Entry has been stored concurrently
+            shutil.rmtree(staging, ignore_errors=True)
+
+    def evict(self):
+        """Remove least recently used entries until the cache fits into max_bytes"""
+        misc.evict_lru(self.directory, self.max_bytes)
+
+def _read_tdms_cached(pathname, keys, groupname, cache):
+    """Read channels of one file through the cache"""
+    if cache is None:
+        return read_tdms(pathname, keys, groupname, lazy=True)
+    data = cache.load(pathname, keys, groupname)
+    if data is None:
+        cache.store(pathname, keys, groupname, read_tdms(pathname, keys, groupname, lazy=True))
+        data = cache.load(pathname, keys, groupname)
+    return data
+
+def read_tdms_files(pathnames, keys, groupname, workers=None, processes=False, cache=None):
+    """
+    Read the same channels from many TDMS files concurrently
+
+    Args:
+        pathnames: list of tdms files
+        keys: list of channel names
+        groupname: name of group, under which the channels are placed
+        workers: number of threads or processes
+        processes: use a process pool instead of a thread pool
+        cache: optional TdmsCache, from which the channels are loaded as memory-mapped arrays
+    Returns:
+        list of channel lists in order of pathnames
+    """
+    if cache is not None:
+        # Content hashes are computed once per batch, so process workers find them in the index
+        cache.index_files(pathnames, workers)
+    executor_class = ProcessPoolExecutor if processes else ThreadPoolExecutor
+    with executor_class(max_workers=workers) as executor:
+        read_file = functools.partial(_read_tdms_cached, keys=keys, groupname=groupname, cache=cache)
+        results = list(executor.map(read_file, pathnames))
+    if cache is not None:
+        cache.evict()
+    return results
 
-def write_tdms(data, keys, groupname, pathname):
+def iter_tdms(pathname, keys, groupname, chunk_size=2**20, start=0, stop=None, prefetch=True):
+    """
+    Generator which reads a TDMS file in aligned multi-channel blocks,
+    e.g. to feed series.ButterLowpassFilter.filter_chunks with recordings larger than memory.
+    Channels are read by sample offsets, so their segment boundaries may differ.
+
+    Args:
+        pathname: name of the tdms file, which will be read
+        keys: list of channel names for each row
+        groupname: name of group, under which the channels are placed
+        chunk_size: number of samples per block, the last block may be shorter
+        start: first sample
+        stop: sample before which reading stops, limited by the shortest channel
+        prefetch: read the next block on a background thread while the current one is processed
+    Yields:
+        numpy array of shape (len(keys), chunk_size)
+    """
+    with TdmsFile.open(pathname) as tdms_file:
+        channels = [tdms_file[groupname][key] for key in keys]
+        length = min(len(channel) for channel in channels)
+        stop = length if stop is None else min(stop, length)
+        offsets = range(start, stop, chunk_size)
+
+        def read_chunk(offset):
+            """Read one aligned block of all channels"""
+            end = min(offset + chunk_size, stop)
+            return np.stack([channel[offset:end] for channel in channels])
+
+        if not prefetch:
+            for offset in offsets:
+                yield read_chunk(offset)
+            return
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            future = executor.submit(read_chunk, offsets[0]) if offsets else None
+            for offset in offsets[1:]:
+                chunk = future.result()
+                future = executor.submit(read_chunk, offset)
+                yield chunk
+            if future is not None:
+                yield future.result()
+
+def write_tdms(data, keys, groupname, pathname, single_segment=True):
     """
     Write data to TDMS file
 
@@ -27,8 +194,76 @@ def write_tdms(data, keys, groupname, pathname):
         keys: list of channel names for each column; len(data) == len(keys) should be true
         groupname: all channels will be placed under this group within the tdms file structure
         pathname: path of the tdms file, which will be generated
+        single_segment: write all channels in one segment instead of one segment per channel
     """
+    channels = [
+        ChannelObject(groupname, keys[idx], np.ascontiguousarray(values))
+        for idx, values in enumerate(data)
+    ]
     with TdmsWriter(pathname) as tdms_writer:
-        for idx, __ in enumerate(data):
-            channel = ChannelObject(groupname, keys[idx], np.array(data[idx]))
-            tdms_writer.write_segment([channel])
+        if single_segment:
+            tdms_writer.write_segment(channels)
+        else:
+            for channel in channels:
+                tdms_writer.write_segment([channel])
+
+class TdmsStreamWriter:
+    """
+    Context manager for appending multi-channel blocks to a TDMS file during acquisition.
+    Blocks are buffered until segment_size samples per channel are reached
+    and written as one segment containing all channels.
+    """
+    def __init__(self, pathname, keys, groupname, segment_size=2**20, mode='w'):
+        """
+        Args:
+            pathname: path of the tdms file, which will be generated
+            keys: list of channel names for each row of the written blocks
+            groupname: all channels will be placed under this group
+            segment_size: number of samples per channel and segment,
+                None writes every block as its own segment
+            mode: 'w' to create a new file or 'a' to append to an existing one
+        """
+        self.keys = keys
+        self.groupname = groupname
+        self.segment_size = segment_size
+        self.tdms_writer = TdmsWriter(pathname, mode=mode)
+        self.tdms_writer.open()
+        self.buffer = []
+        self.buffered = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write(self, block):
+        """Write block of shape (len(keys), samples), which may be reused by the caller"""
+        if self.segment_size is None:
+            self.buffer.append(block)
+        else:
+            # Buffered blocks are copied, as acquisition loops often refill the same array
+            self.buffer.append(np.array(block, copy=True))
+        self.buffered += np.shape(block)[-1]
+        if self.segment_size is None or self.buffered >= self.segment_size:
+            self.flush()
+
+    def flush(self):
+        """Write buffered blocks as one segment"""
+        if not self.buffer:
+            return
+        if len(self.buffer) == 1:
+            data = self.buffer[0]
+        else:
+            data = np.concatenate([np.asarray(block) for block in self.buffer], axis=-1)
+        self.tdms_writer.write_segment([
+            ChannelObject(self.groupname, key, np.ascontiguousarray(data[idx]))
+            for idx, key in enumerate(self.keys)
+        ])
+        self.buffer = []
+        self.buffered = 0
+
+    def close(self):
+        """Flush remaining blocks and close file"""
+        self.flush()
+        self.tdms_writer.close()